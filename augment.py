@@ -7,6 +7,8 @@ import jinja2
 from jinja2 import Environment, FileSystemLoader
 from openai import AsyncOpenAI
 
+from database.llm_cache import open_llm_cache
+
 
 class Augmentor:
     def __init__(self, model: str):
@@ -19,20 +21,24 @@ class Augmentor:
         with open("prompt/augment_assistant.txt") as fp:
             self.assistant_prompt = fp.read()
         self.client = AsyncOpenAI()
+        self.cache = open_llm_cache()
         self.model = model
         self.pattern = re.compile(r'Paraphrase:\s*"([^"]+)"')
 
     async def augment(self, user_input: str) -> str | None:
         prompt = await self.template.render_async(input=user_input)
+        messages = [
+            {"role": "assistant", "content": self.assistant_prompt},
+            {"role": "user", "content": prompt},
+        ]
+        if self.cache is not None and (answer := self.cache.get(self.model, messages)) is not None:
+            return self.parse(answer)
         response = None
         for _ in range(5):
             try:
                 response = await self.client.chat.completions.create(
                     model=self.model,
-                    messages=[
-                        {"role": "assistant", "content": self.assistant_prompt},
-                        {"role": "user", "content": prompt},
-                    ],
+                    messages=messages,
                     stream=False,
                 )
             except JSONDecodeError:
@@ -42,6 +48,11 @@ class Augmentor:
         if response is None:
             return user_input
         answer = response.choices[0].message.content
+        if self.cache is not None:
+            self.cache.put(self.model, messages, answer)
+        return self.parse(answer)
+
+    def parse(self, answer: str) -> str:
         try:
             return self.pattern.search(answer).group(1)
         except AttributeError:
@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+import logging
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from database.vector_backend import Hit, SearchFilter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Request:
+    query: list[str]
+    num_results: int
+    where: SearchFilter | None
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+class SearchBatcher:
+    """Coalesces concurrent nearest-neighbour searches into one call of ``search``.
+
+    Requests are collected for at most ``window`` seconds after the first one arrives, or until ``max_size`` queries are pending.
+    Requests with different filters share the window but are searched in separate calls.
+    """
+
+    def __init__(self, search: Callable[[list[str], int, SearchFilter | None], Awaitable[list[list[Hit]]]], window: float, max_size: int):
+        self.search = search
+        self.window = window
+        self.max_size = max_size
+        self.queue: asyncio.Queue[_Request | None] = asyncio.Queue()
+        self.batch_sizes = Counter()
+        self.max_queue_depth = 0
+        self.task: asyncio.Task | None = None
+
+    async def submit(self, query: list[str], num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]:
+        if self.task is None:
+            # Not in the context of the request that happens to start it, whose timings would get every batch's stages
+            self.task = asyncio.create_task(self._run(), context=contextvars.Context())
+        request = _Request(query, num_results, where or None)
+        self.queue.put_nowait(request)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await request.future
+
+    async def close(self):
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            # Number of batches by the smallest power of two not below their size
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while (request := await self.queue.get()) is not None:
+            batch = [request]
+            size = len(request.query)
+            deadline = loop.time() + self.window
+            stopping = False
+            while size < self.max_size and (timeout := deadline - loop.time()) > 0:
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except TimeoutError:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                size += len(request.query)
+            groups: dict[SearchFilter | None, list[_Request]] = {}
+            for r in batch:
+                groups.setdefault(r.where, []).append(r)
+            for group in groups.values():
+                await self._process(group)
+            if stopping:
+                return
+
+    async def _process(self, batch: list[_Request]):
+        # Callers that went away while waiting are not searched for
+        batch = [r for r in batch if not r.future.done()]
+        if not batch:
+            return
+        query = [q for r in batch for q in r.query]
+        self.batch_sizes[1 << (len(query) - 1).bit_length()] += 1
+        logger.debug("searching %d queries from %d requests", len(query), len(batch))
+        try:
+            results = await self.search(query, max(r.num_results for r in batch), batch[0].where)
+        except Exception as e:
+            for r in batch:
+                if not r.future.done():
+                    r.future.set_exception(e)
+            return
+        offset = 0
+        for r in batch:
+            if not r.future.done():
+                r.future.set_result([hits[: r.num_results] for hits in results[offset : offset + len(r.query)]])
+            offset += len(r.query)
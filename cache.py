@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import dataclass
+
+from psycopg import AsyncConnection
+
+from database.vector_backend import SearchFilter
+from retrieve import QueryResult, RecordField
+
+logger = logging.getLogger(__name__)
+
+Fields = tuple[RecordField, ...] | None
+Search = Callable[[list[str], int, SearchFilter | None, Fields], Awaitable[list[list[QueryResult]]]]
+StreamSearch = Callable[[list[str], int, SearchFilter | None, Fields], AsyncIterator[tuple[int, list[QueryResult]]]]
+Key = tuple[str, SearchFilter | None, Fields]
+
+
+class _Abandoned(Exception):
+    """Set on the searches of a request that stopped consuming results before they were done."""
+
+
+@dataclass
+class _Entry:
+    version: int
+    num_results: int
+    results: list[QueryResult]
+
+    def covers(self, num_results: int) -> bool:
+        # Fewer results than asked for means the index has no more to give
+        return num_results <= self.num_results or len(self.results) < self.num_results
+
+
+class ResultCache:
+    """An LRU of search results keyed on the query, its filter and the selected fields, retired whenever ``index_version`` moves.
+
+    A cached top-N list also answers any smaller ``num_results``, and identical queries in flight are computed only once.
+    ``on_version`` is called with the version at every check, for other state derived from the index to follow it. A
+    new version is only taken once it returns ``True``, so that results computed from the previous state meanwhile are
+    retired; on ``False`` the check is repeated after the interval.
+    """
+
+    def __init__(self, size: int, version_interval: float, on_version: Callable[[int], Awaitable[bool]] | None = None):
+        self.size = size
+        self.version_interval = version_interval
+        self.on_version = on_version
+        self.version = -1
+        self.version_checked = float("-inf")
+        self.updating = False
+        self.entries: OrderedDict[Key, _Entry] = OrderedDict()
+        self.inflight: dict[Key, tuple[int, asyncio.Future]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def check_version(self, conn: AsyncConnection):
+        now = time.monotonic()
+        if now - self.version_checked < self.version_interval or self.updating:
+            return
+        self.version_checked = now
+        cursor = await conn.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM index_version")
+        (version,) = await cursor.fetchone()
+        if self.on_version is not None:
+            self.updating = True
+            try:
+                if not await self.on_version(version):
+                    return
+            finally:
+                self.updating = False
+        if version != self.version:
+            logger.info("index version changed from %d to %d; clearing %d cached results", self.version, version, len(self.entries))
+            self.version = version
+            self.entries.clear()
+
+    async def batch_search(self, conn: AsyncConnection, query: list[str], num_results: int, search: Search, where: SearchFilter | None = None, fields: Fields = None) -> list[list[QueryResult]]:
+        async def stream(query: list[str], num_results: int, where: SearchFilter | None, fields: Fields) -> AsyncIterator[tuple[int, list[QueryResult]]]:
+            for i, rs in enumerate(await search(query, num_results, where, fields)):
+                yield i, rs
+
+        ret: list[list[QueryResult] | None] = [None] * len(query)
+        async for i, rs in self.iter_search(conn, query, num_results, stream, where, fields):
+            ret[i] = rs
+        return ret
+
+    async def iter_search(self, conn: AsyncConnection, query: list[str], num_results: int, search: StreamSearch, where: SearchFilter | None = None, fields: Fields = None) -> AsyncIterator[tuple[int, list[QueryResult]]]:
+        """Yields ``(i, results)`` for the ``i``-th query: cached results first, then the others as ``search`` produces them."""
+        await self.check_version(conn)
+        version = self.version
+        where = where or None
+        waiting: list[tuple[int, Key, asyncio.Future]] = []
+        missing: dict[Key, list[int]] = {}
+        for i, q in enumerate(query):
+            q = (q, where, fields)
+            entry = self.entries.get(q)
+            if entry is not None and entry.covers(num_results):
+                self.entries.move_to_end(q)
+                self.hits += 1
+                yield i, entry.results[:num_results]
+            elif q in self.inflight and self.inflight[q][0] >= num_results:
+                self.coalesced += 1
+                waiting.append((i, q, self.inflight[q][1]))
+            else:
+                self.misses += 1
+                missing.setdefault(q, []).append(i)
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            keys = list(missing)
+            futures = {q: loop.create_future() for q in keys}
+            for q, future in futures.items():
+                self.inflight[q] = (num_results, future)
+            try:
+                async for j, rs in search([q for q, _, _ in keys], num_results, where, fields):
+                    futures[keys[j]].set_result(rs)
+                    if version == self.version:
+                        self._insert(keys[j], _Entry(version, num_results, rs))
+                    for i in missing[keys[j]]:
+                        yield i, rs
+            except Exception as e:
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+                        # Mark as retrieved in case no other request is waiting on it
+                        future.exception()
+                raise
+            finally:
+                for q, future in futures.items():
+                    # The caller stopped consuming results before this one was searched
+                    if not future.done():
+                        future.set_exception(_Abandoned(f"search for {q[0]!r} was abandoned"))
+                        future.exception()
+                    if self.inflight.get(q, (0, None))[1] is future:
+                        del self.inflight[q]
+
+        for i, q, future in waiting:
+            try:
+                results = await future
+            except _Abandoned:
+                # The request computing it went away, so it is searched again, or joins another search of it
+                async for _, results in self.iter_search(conn, [q[0]], num_results, search, where, fields):
+                    pass
+            yield i, results[:num_results]
+
+    def _insert(self, key: Key, entry: _Entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "size": len(self.entries), "version": self.version}
@@ -5,10 +5,12 @@ import psycopg
 from jixia import LeanProject
 from jixia.structs import parse_name
 
-from .informalize import generate_informal
+from .informalize import backfill_input_hashes, generate_informal
+from .record_store import export_records
 from .jixia_db import load_data
-from .vector_db import create_vector_db
-from .create_schema import create_schema
+from .vector_backend import open_vector_backend
+from .vector_db import backfill_document_hashes, create_vector_db
+from .create_schema import bump_index_version, create_schema, refresh_record, upgrade_schema
 
 
 def main():
@@ -16,6 +18,16 @@ def main():
     subparser = parser.add_subparsers()
     schema_parser = subparser.add_parser("schema")
     schema_parser.set_defaults(command="schema")
+    schema_parser.add_argument(
+        "--materialized-record",
+        action="store_true",
+        help="Store the record view as an indexed materialized view, refreshed by the informal command",
+    )
+    schema_parser.add_argument(
+        "--upgrade",
+        action="store_true",
+        help="Upgrade the schema of an existing database and its vector index for incremental reindexing instead of creating it",
+    )
     jixia_parser = subparser.add_parser("jixia")
     jixia_parser.set_defaults(command="jixia")
     jixia_parser.add_argument("project_root", help="Project to be indexed")
@@ -23,9 +35,16 @@ def main():
         "prefixes",
         help="Comma-separated list of module prefixes to be included in the index; e.g., Init,Mathlib",
     )
+    jixia_parser.add_argument("--processes", type=int, help="Number of processes parsing jixia output; one per core by default")
     informal_parser = subparser.add_parser("informal")
     informal_parser.set_defaults(command="informal")
-    informal_parser.add_argument("--batch-size", type=int, default=50)
+    informal_parser.add_argument(
+        "--concurrency",
+        "--batch-size",
+        type=int,
+        default=50,
+        help="Number of translation requests in flight",
+    )
     informal_parser.add_argument(
         "--limit-level",
         type=int,
@@ -39,22 +58,48 @@ def main():
     vector_db_parser = subparser.add_parser("vector-db")
     vector_db_parser.set_defaults(command="vector-db")
     vector_db_parser.add_argument("--batch-size", type=int, default=8)
+    vector_db_parser.add_argument("--concurrency", type=int, default=4, help="Number of embedding requests in flight")
+    vector_eval_parser = subparser.add_parser("vector-eval", help="Report recall and memory of a quantized vector index")
+    vector_eval_parser.set_defaults(command="vector-eval")
+    vector_eval_parser.add_argument("--queries", type=int, default=200, help="Number of indexed vectors used as queries")
+    vector_eval_parser.add_argument("-k", type=int, default=10)
+    records_parser = subparser.add_parser("records")
+    records_parser.set_defaults(command="records")
+    records_parser.add_argument("path", help="File to write the memory-mapped record store to")
 
     args = parser.parse_args()
 
     with psycopg.connect(os.environ["CONNECTION_STRING"], autocommit=True) as conn:
-        if args.command == "schema":
-            create_schema(conn)
+        if args.command == "schema" and args.upgrade:
+            upgrade_schema(conn)
+            backfill_input_hashes(conn)
+            if os.path.exists(os.environ["CHROMA_PATH"]):
+                backfill_document_hashes(conn, os.environ["CHROMA_PATH"])
+        elif args.command == "schema":
+            create_schema(conn, materialized_record=args.materialized_record)
         elif args.command == "jixia":
             project = LeanProject(args.project_root)
             prefixes = [parse_name(p) for p in args.prefixes.split(",")]
-            load_data(project, prefixes, conn)
+            load_data(project, prefixes, conn, processes=args.processes)
+            bump_index_version(conn)
         elif args.command == "informal":
             generate_informal(
                 conn,
-                batch_size=args.batch_size,
+                concurrency=args.concurrency,
                 limit_level=args.limit_level,
                 limit_num_per_level=args.limit_num_per_level,
             )
+            refresh_record(conn)
+            bump_index_version(conn)
         elif args.command == "vector-db":
-            create_vector_db(conn, os.environ["CHROMA_PATH"], batch_size=args.batch_size)
+            create_vector_db(conn, os.environ["CHROMA_PATH"], batch_size=args.batch_size, concurrency=args.concurrency)
+            bump_index_version(conn)
+        elif args.command == "vector-eval":
+            backend = open_vector_backend(os.environ["CHROMA_PATH"])
+            if not hasattr(backend, "evaluate"):
+                vector_eval_parser.error(f"the {os.environ.get('VECTOR_BACKEND', 'chroma')} backend has no quantized index to evaluate; set VECTOR_BACKEND=int8")
+            report = backend.evaluate(args.queries, args.k)
+            for key, value in report.items():
+                print(f"{key}: {value}")
+        elif args.command == "records":
+            export_records(conn, args.path)
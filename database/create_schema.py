@@ -2,7 +2,29 @@ from typing import LiteralString
 from psycopg import Connection
 
 
-def create_schema(conn: Connection):
+RECORD_QUERY = """
+    SELECT
+        d.module_name, d.index, d.kind, s.name, LOWER(d.range) AS start, UPPER(d.range) AS stop, d.signature, s.type, d.value, d.docstring,
+        i.name AS informal_name, i.description AS informal_description
+    FROM
+        declaration d
+        INNER JOIN informal i ON d.symbol_id = i.symbol_id
+        INNER JOIN symbol s ON d.symbol_id = s.id
+"""
+
+
+def record_view(materialized: bool) -> list[LiteralString]:
+    if materialized:
+        # Search hits and fetched names are then looked up with a single index probe instead of a join
+        return [
+            "CREATE MATERIALIZED VIEW record AS" + RECORD_QUERY,
+            "CREATE UNIQUE INDEX record_module_name_index ON record (module_name, index)",
+            "CREATE UNIQUE INDEX record_name ON record (name)",
+        ]
+    return ["CREATE VIEW record AS" + RECORD_QUERY]
+
+
+def create_schema(conn: Connection, materialized_record: bool = False):
     sql: list[LiteralString] = [
         """
         CREATE TABLE module (
@@ -38,8 +60,9 @@ def create_schema(conn: Connection):
         )""",
         """
         CREATE TABLE symbol (
-            name JSONB PRIMARY KEY,
-            module_name JSONB REFERENCES module(name) NOT NULL,
+            id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            name JSONB UNIQUE NOT NULL,
+            module_name JSONB REFERENCES module(name) ON DELETE CASCADE NOT NULL,
             kind symbol_kind NOT NULL,
             type TEXT NOT NULL,
             is_prop BOOLEAN NOT NULL
@@ -47,9 +70,9 @@ def create_schema(conn: Connection):
         """,
         """
         CREATE TABLE declaration (
-            module_name JSONB REFERENCES module(name) NOT NULL,
+            module_name JSONB REFERENCES module(name) ON DELETE CASCADE NOT NULL,
             index INTEGER NOT NULL,
-            name JSONB UNIQUE REFERENCES symbol(name),
+            symbol_id INTEGER UNIQUE REFERENCES symbol(id) ON DELETE CASCADE,
             visible BOOLEAN NOT NULL,
             docstring TEXT,
             kind declaration_kind NOT NULL,
@@ -61,34 +84,30 @@ def create_schema(conn: Connection):
         """,
         """
         CREATE TABLE dependency (
-            source JSONB REFERENCES symbol(name) NOT NULL,
-            target JSONB REFERENCES symbol(name) NOT NULL,
+            source INTEGER REFERENCES symbol(id) ON DELETE CASCADE NOT NULL,
+            target INTEGER REFERENCES symbol(id) ON DELETE CASCADE NOT NULL,
             on_type BOOLEAN NOT NULL,
             PRIMARY KEY (source, target, on_type)
         )
         """,
         """
         CREATE TABLE level (
-            symbol_name JSONB PRIMARY KEY REFERENCES symbol(name) NOT NULL,
+            symbol_id INTEGER PRIMARY KEY REFERENCES symbol(id) ON DELETE CASCADE NOT NULL,
             level INTEGER NOT NULL
         )
         """,
         """
         CREATE TABLE informal (
-            symbol_name JSONB PRIMARY KEY REFERENCES symbol(name) NOT NULL,
+            symbol_id INTEGER PRIMARY KEY REFERENCES symbol(id) ON DELETE CASCADE NOT NULL,
             name TEXT NOT NULL,
-            description TEXT NOT NULL
+            description TEXT NOT NULL,
+            input_hash TEXT
         )
         """,
+        *record_view(materialized_record),
+
         """
-        CREATE VIEW record AS
-        SELECT
-            d.module_name, d.index, d.kind, d.name, d.range, d.signature, s.type, d.value, d.docstring,
-            i.name AS informal_name, i.description AS informal_description
-        FROM
-            declaration d
-            INNER JOIN informal i ON d.name = i.symbol_name
-            INNER JOIN symbol s ON d.name = s.name
+        CREATE SEQUENCE index_version
         """,
 
         """
@@ -105,7 +124,7 @@ def create_schema(conn: Connection):
         """
         CREATE TABLE leansearch.feedback (
             query_id UUID REFERENCES leansearch.query(id) NOT NULL,
-            declaration_name JSONB REFERENCES declaration(name) NOT NULL,
+            declaration_name JSONB NOT NULL,
             action TEXT NOT NULL,
             PRIMARY KEY (query_id, declaration_name)
         )"""
@@ -114,3 +133,113 @@ def create_schema(conn: Connection):
     with conn.cursor() as cursor:
         for s in sql:
             cursor.execute(s)
+
+
+# Re-keys a database created when symbols were keyed by their name, before they had an integer id. The record view,
+# which depends on the name columns, is dropped beforehand and created again afterwards.
+LEGACY_UPGRADE: list[LiteralString] = [
+    "ALTER TABLE leansearch.feedback DROP CONSTRAINT IF EXISTS feedback_declaration_name_fkey",
+    "ALTER TABLE symbol ADD COLUMN id INTEGER GENERATED ALWAYS AS IDENTITY",
+    "ALTER TABLE declaration ADD COLUMN symbol_id INTEGER",
+    "UPDATE declaration d SET symbol_id = s.id FROM symbol s WHERE d.name = s.name",
+    "ALTER TABLE dependency ADD COLUMN source_id INTEGER, ADD COLUMN target_id INTEGER",
+    "UPDATE dependency e SET source_id = s.id, target_id = t.id FROM symbol s, symbol t WHERE e.source = s.name AND e.target = t.name",
+    "ALTER TABLE level ADD COLUMN symbol_id INTEGER",
+    "UPDATE level l SET symbol_id = s.id FROM symbol s WHERE l.symbol_name = s.name",
+    "ALTER TABLE informal ADD COLUMN symbol_id INTEGER",
+    "UPDATE informal i SET symbol_id = s.id FROM symbol s WHERE i.symbol_name = s.name",
+    # Dropping the name columns also drops the keys on them, and the foreign keys to symbol(name)
+    "ALTER TABLE declaration DROP COLUMN name",
+    "ALTER TABLE dependency DROP COLUMN source, DROP COLUMN target",
+    "ALTER TABLE dependency RENAME COLUMN source_id TO source",
+    "ALTER TABLE dependency RENAME COLUMN target_id TO target",
+    "ALTER TABLE level DROP COLUMN symbol_name",
+    "ALTER TABLE informal DROP COLUMN symbol_name",
+    "ALTER TABLE symbol DROP CONSTRAINT symbol_pkey, ADD PRIMARY KEY (id), ADD UNIQUE (name)",
+    "ALTER TABLE declaration ADD UNIQUE (symbol_id), ADD FOREIGN KEY (symbol_id) REFERENCES symbol(id)",
+    """
+    ALTER TABLE dependency
+        ALTER COLUMN source SET NOT NULL,
+        ALTER COLUMN target SET NOT NULL,
+        ADD PRIMARY KEY (source, target, on_type),
+        ADD FOREIGN KEY (source) REFERENCES symbol(id),
+        ADD FOREIGN KEY (target) REFERENCES symbol(id)
+    """,
+    "ALTER TABLE level ALTER COLUMN symbol_id SET NOT NULL, ADD PRIMARY KEY (symbol_id), ADD FOREIGN KEY (symbol_id) REFERENCES symbol(id)",
+    "ALTER TABLE informal ALTER COLUMN symbol_id SET NOT NULL, ADD PRIMARY KEY (symbol_id), ADD FOREIGN KEY (symbol_id) REFERENCES symbol(id)",
+]
+
+# Brings a database created before incremental reindexing up to date. Declarations removed from the project are
+# deleted along with everything derived from them, and feedback keeps the names of removed declarations.
+UPGRADE: list[LiteralString] = [
+    "CREATE SEQUENCE IF NOT EXISTS index_version",
+    "ALTER TABLE informal ADD COLUMN IF NOT EXISTS input_hash TEXT",
+    "ALTER TABLE leansearch.feedback DROP CONSTRAINT IF EXISTS feedback_declaration_name_fkey",
+    """
+    ALTER TABLE symbol
+        DROP CONSTRAINT symbol_module_name_fkey,
+        ADD CONSTRAINT symbol_module_name_fkey FOREIGN KEY (module_name) REFERENCES module(name) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE declaration
+        DROP CONSTRAINT declaration_module_name_fkey,
+        ADD CONSTRAINT declaration_module_name_fkey FOREIGN KEY (module_name) REFERENCES module(name) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE declaration
+        DROP CONSTRAINT declaration_symbol_id_fkey,
+        ADD CONSTRAINT declaration_symbol_id_fkey FOREIGN KEY (symbol_id) REFERENCES symbol(id) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE dependency
+        DROP CONSTRAINT dependency_source_fkey,
+        ADD CONSTRAINT dependency_source_fkey FOREIGN KEY (source) REFERENCES symbol(id) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE dependency
+        DROP CONSTRAINT dependency_target_fkey,
+        ADD CONSTRAINT dependency_target_fkey FOREIGN KEY (target) REFERENCES symbol(id) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE level
+        DROP CONSTRAINT level_symbol_id_fkey,
+        ADD CONSTRAINT level_symbol_id_fkey FOREIGN KEY (symbol_id) REFERENCES symbol(id) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE informal
+        DROP CONSTRAINT informal_symbol_id_fkey,
+        ADD CONSTRAINT informal_symbol_id_fkey FOREIGN KEY (symbol_id) REFERENCES symbol(id) ON DELETE CASCADE
+    """,
+]
+
+
+def upgrade_schema(conn: Connection):
+    with conn.transaction(), conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = CURRENT_SCHEMA AND table_name = 'symbol' AND column_name = 'id'")
+        legacy = cursor.fetchone() is None
+        if legacy:
+            cursor.execute("SELECT 1 FROM pg_matviews WHERE matviewname = 'record'")
+            materialized = cursor.fetchone() is not None
+            cursor.execute("DROP MATERIALIZED VIEW IF EXISTS record" if materialized else "DROP VIEW IF EXISTS record")
+            for s in LEGACY_UPGRADE:
+                cursor.execute(s)
+            for s in record_view(materialized):
+                cursor.execute(s)
+        for s in UPGRADE:
+            cursor.execute(s)
+
+
+def refresh_record(conn: Connection):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_matviews WHERE matviewname = 'record'")
+        if cursor.fetchone() is not None:
+            # CONCURRENTLY keeps the old contents readable by the search server during the refresh
+            cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY record")
+
+
+def bump_index_version(conn: Connection):
+    # Lets running search servers retire results cached from the previous index. The version is a random stamp rather
+    # than the next number, as a database recreated by `make reset` would count up to the same versions again, which
+    # record stores exported from the previous database would then claim.
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT SETVAL('index_version', 1 + FLOOR(RANDOM() * 9e18)::BIGINT)")
@@ -1,5 +1,11 @@
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
 
+import httpx
+import numpy as np
 import requests
 from chromadb import Documents, Embeddings
 
@@ -11,15 +17,189 @@ DIMENSION = 4096
 MAX_LENGTH = 4096
 
 
+class EmbeddingStore:
+    """A fixed number of float16 embeddings in a memory-mapped file, overwritten in ring order once full.
+
+    ``keys.txt`` is an append-only log of ``<slot> <key>`` lines; the last line for a slot wins.
+    The store must not be shared between processes.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.capacity = capacity
+        vectors_path = self.path / "vectors.f16"
+        keys_path = self.path / "keys.txt"
+        shape = (capacity, DIMENSION)
+        if vectors_path.exists() and vectors_path.stat().st_size != capacity * DIMENSION * 2:
+            logger.warning("embedding store at %s has a different capacity; discarding it", self.path)
+            vectors_path.unlink()
+            keys_path.unlink(missing_ok=True)
+        self.vectors = np.memmap(vectors_path, dtype=np.float16, mode="r+" if vectors_path.exists() else "w+", shape=shape)
+
+        self.keys: list[str | None] = [None] * capacity
+        self.slots: dict[str, int] = {}
+        self.next_slot = 0
+        num_lines = 0
+        if keys_path.exists():
+            with open(keys_path) as fp:
+                for line in fp:
+                    slot, _, key = line.rstrip("\n").partition(" ")
+                    self._assign(int(slot), key)
+                    self.next_slot = (int(slot) + 1) % capacity
+                    num_lines += 1
+        if num_lines > 2 * capacity:
+            self._compact(keys_path)
+        self.log = open(keys_path, "a")
+
+    def _assign(self, slot: int, key: str):
+        old = self.keys[slot]
+        if old is not None:
+            del self.slots[old]
+        self.keys[slot] = key
+        self.slots[key] = slot
+
+    def _compact(self, keys_path: Path):
+        # Oldest slot first, so that the position of the last line still tells where to write next
+        order = [(self.next_slot + i) % self.capacity for i in range(self.capacity)]
+        with open(keys_path, "w") as fp:
+            for slot in order:
+                if self.keys[slot] is not None:
+                    fp.write(f"{slot} {self.keys[slot]}\n")
+
+    def get(self, key: str) -> list[float] | None:
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return self.vectors[slot].astype(np.float32).tolist()
+
+    def put(self, key: str, embedding: list[float]):
+        if key in self.slots:
+            return
+        slot = self.next_slot
+        self.vectors[slot] = embedding
+        self._assign(slot, key)
+        self.next_slot = (slot + 1) % self.capacity
+        self.log.write(f"{slot} {key}\n")
+        self.log.flush()
+
+    def close(self):
+        self.vectors.flush()
+        self.log.close()
+
+
+class EmbeddingCache:
+    """An LRU of query embeddings in front of an optional persistent :class:`EmbeddingStore`."""
+
+    def __init__(self, size: int, store: EmbeddingStore | None = None):
+        self.size = size
+        self.store = store
+        self.entries: OrderedDict[str, list[float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> list[float] | None:
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            if self.store is not None:
+                embedding = self.store.get(key)
+                if embedding is not None:
+                    self._insert(key, embedding)
+                    self.store_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, key: str, embedding: list[float]):
+        with self.lock:
+            self._insert(key, embedding)
+            if self.store is not None:
+                self.store.put(key, embedding)
+
+    def _insert(self, key: str, embedding: list[float]):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "store_hits": self.store_hits, "misses": self.misses, "size": len(self.entries)}
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+
+def _checked(docs: Documents, embeddings) -> Embeddings:
+    # Anything else in a successful response would otherwise be cached as the embeddings of the documents
+    if not (isinstance(embeddings, list) and len(embeddings) == len(docs) and all(isinstance(e, list) and len(e) == DIMENSION for e in embeddings)):
+        raise ValueError(f"expected {len(docs)} embeddings of dimension {DIMENSION} from the embedding server")
+    return embeddings
+
+
 class MistralEmbedding:
-    def __init__(self, url: str, instruction: str):
+    def __init__(self, url: str, instruction: str, cache: EmbeddingCache | None = None):
         self.instruction = instruction
         self.url = url
+        self.cache = cache
+        self.client: httpx.AsyncClient | None = None
 
     def get_detailed_instruct(self, query: str) -> str:
         return f"Instruct: {self.instruction}\nDoc: {query}"
 
+    def cache_key(self, doc: str) -> str:
+        return hashlib.sha256(self.get_detailed_instruct(doc[:MAX_LENGTH]).encode()).hexdigest()
+
     def embed(self, docs: Documents) -> Embeddings:
+        keys, ret, missing = self._lookup(docs)
+        if missing:
+            ret = self._store(keys, ret, missing, self._embed(list(missing.values())))
+        return ret
+
+    async def aembed(self, docs: Documents) -> Embeddings:
+        keys, ret, missing = self._lookup(docs)
+        if missing:
+            ret = self._store(keys, ret, missing, await self._aembed(list(missing.values())))
+        return ret
+
+    def _lookup(self, docs: Documents) -> tuple[list[str], list[list[float] | None], dict[str, str]]:
+        if self.cache is None:
+            return [], [None] * len(docs), dict(enumerate(docs))
+        keys = [self.cache_key(doc) for doc in docs]
+        ret = [self.cache.get(key) for key in keys]
+        # Identical documents within one batch are sent only once
+        missing = {key: doc for key, doc, embedding in zip(keys, docs, ret) if embedding is None}
+        return keys, ret, missing
+
+    def _store(self, keys: list[str], ret: list[list[float] | None], missing: dict, embeddings: Embeddings) -> Embeddings:
+        if self.cache is None:
+            return embeddings
+        computed = dict(zip(missing, embeddings))
+        for key, embedding in computed.items():
+            self.cache.put(key, embedding)
+        return [computed[key] if embedding is None else embedding for key, embedding in zip(keys, ret)]
+
+    def _embed(self, docs: Documents) -> Embeddings:
         detailed_docs = [self.get_detailed_instruct(doc[:MAX_LENGTH]) for doc in docs]
         response = requests.post(self.url, json=detailed_docs)
-        return response.json()
+        response.raise_for_status()
+        return _checked(docs, response.json())
+
+    async def _aembed(self, docs: Documents) -> Embeddings:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=None)
+        detailed_docs = [self.get_detailed_instruct(doc[:MAX_LENGTH]) for doc in docs]
+        response = await self.client.post(self.url, json=detailed_docs)
+        response.raise_for_status()
+        return _checked(docs, response.json())
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
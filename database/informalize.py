@@ -1,10 +1,11 @@
 import asyncio
 import logging
 import os
+import time
+from collections import Counter, defaultdict, deque
 
 from jixia.structs import LeanName
 from psycopg import Connection
-from psycopg.rows import scalar_row, args_row
 from psycopg.types.json import Jsonb
 
 from .translate import TranslatedItem, TranslationInput, TranslationEnvironment
@@ -12,109 +13,248 @@ from .translate import TranslatedItem, TranslationInput, TranslationEnvironment
 logger = logging.getLogger(__name__)
 
 
-def find_neighbor(conn: Connection, module_name: LeanName, index: int, num_neighbor: int = 2) -> list[TranslatedItem]:
-    with conn.cursor(row_factory=args_row(TranslatedItem)) as cursor:
+def find_neighbors(conn: Connection, declarations: list[tuple[int, LeanName, int]], num_neighbor: int = 2) -> dict[int, list[TranslatedItem]]:
+    """Declarations within ``num_neighbor`` of each ``(symbol_id, module_name, index)`` in its module, by symbol id."""
+    ret: dict[int, list[TranslatedItem]] = defaultdict(list)
+    with conn.cursor() as cursor:
         cursor.execute(
             """
-            SELECT d.name, d.signature, i.name, i.description
+            SELECT q.symbol_id, s.name, d.signature, i.name, i.description
+            FROM
+                UNNEST(%s::INTEGER[], %s::JSONB[], %s::INTEGER[]) AS q(symbol_id, module_name, index)
+                INNER JOIN declaration d ON d.module_name = q.module_name AND d.index BETWEEN q.index - %s AND q.index + %s
+                INNER JOIN symbol s ON d.symbol_id = s.id
+                LEFT JOIN informal i ON d.symbol_id = i.symbol_id
+            ORDER BY q.symbol_id, d.index
+            """,
+            ([d[0] for d in declarations], [Jsonb(d[1]) for d in declarations], [d[2] for d in declarations], num_neighbor, num_neighbor),
+        )
+        for symbol_id, *item in cursor:
+            ret[symbol_id].append(TranslatedItem(*item))
+    return ret
+
+
+def find_dependencies(conn: Connection, symbol_ids: list[int]) -> dict[int, list[TranslatedItem]]:
+    ret: dict[int, list[TranslatedItem]] = defaultdict(list)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT e.source, s.name, d.signature, i.name, i.description
             FROM
                 declaration d
-                LEFT JOIN informal i ON d.name = i.symbol_name
+                INNER JOIN dependency e ON d.symbol_id = e.target
+                INNER JOIN symbol s ON d.symbol_id = s.id
+                LEFT JOIN informal i ON d.symbol_id = i.symbol_id
             WHERE
-                d.module_name = %s AND d.index >= %s AND d.index <= %s
+                e.source = ANY(%s)
             """,
-            (Jsonb(module_name), index - num_neighbor, index + num_neighbor),
+            (symbol_ids,),
         )
-        return cursor.fetchall()
+        for source, *item in cursor:
+            ret[source].append(TranslatedItem(*item))
+    return ret
+
 
+def prepare_inputs(conn: Connection, symbol_ids: list[int]) -> list[tuple[int, TranslationInput | None]]:
+    """Translation inputs of the symbols with their context, or ``None`` for those unchanged since their translation.
 
-def find_dependency(conn: Connection, name: LeanName) -> list[TranslatedItem]:
-    with conn.cursor(row_factory=args_row(TranslatedItem)) as cursor:
+    The context of all the symbols is read with a fixed number of queries.
+    """
+    with conn.cursor() as cursor:
         cursor.execute(
             """
-            SELECT d.name, d.signature, i.name, i.description
+            SELECT s.id, s.name, s.kind, s.type, d.signature, d.value, d.docstring, m.docstring, d.module_name, d.index, i.input_hash
             FROM
-                declaration d
-                INNER JOIN dependency e ON d.name = e.target
-                LEFT JOIN informal i ON d.name = i.symbol_name
+                symbol s
+                LEFT JOIN declaration d ON s.id = d.symbol_id
+                INNER JOIN module m ON s.module_name = m.name
+                LEFT JOIN informal i ON s.id = i.symbol_id
             WHERE
-                e.source = %s
+                s.id = ANY(%s)
             """,
-            (Jsonb(name),),
+            (symbol_ids,),
+        )
+        rows = cursor.fetchall()
+    dependencies = find_dependencies(conn, symbol_ids)
+
+    ret: list[tuple[int, TranslationInput | None]] = []
+    changed: list[tuple[int, TranslationInput]] = []
+    declarations = []
+    for symbol_id, name, kind, tp, signature, value, docstring, header, module_name, index, input_hash in rows:
+        ti = TranslationInput(
+            name=name,
+            signature=signature if signature is not None else tp,
+            value=value,
+            docstring=docstring,
+            kind=kind,
+            header=header,
+            neighbor=[],
+            dependency=dependencies[symbol_id],
+        )
+        # Unchanged since the last translation, including the informal descriptions of its dependencies
+        if ti.input_hash == input_hash:
+            ret.append((symbol_id, None))
+            continue
+        changed.append((symbol_id, ti))
+        if module_name is not None:
+            declarations.append((symbol_id, module_name, index))
+    neighbors = find_neighbors(conn, declarations)
+    for symbol_id, ti in changed:
+        ti.neighbor = neighbors[symbol_id]
+        ret.append((symbol_id, ti))
+    return ret
+
+
+def backfill_input_hashes(conn: Connection, batch_size: int = 1000):
+    """Records the input hash of translations made before it was stored, so that they are only redone once changed.
+
+    Meant to run on upgrade, before the project is parsed again, when the database still holds what they were made from.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT symbol_id FROM informal WHERE input_hash IS NULL")
+        symbol_ids = [symbol_id for (symbol_id,) in cursor]
+    for start in range(0, len(symbol_ids), batch_size):
+        inputs = [(symbol_id, ti) for symbol_id, ti in prepare_inputs(conn, symbol_ids[start : start + batch_size]) if ti is not None]
+        conn.execute(
+            "UPDATE informal i SET input_hash = u.input_hash FROM UNNEST(%s::INTEGER[], %s::TEXT[]) AS u(symbol_id, input_hash) WHERE i.symbol_id = u.symbol_id",
+            ([symbol_id for symbol_id, _ in inputs], [ti.input_hash for _, ti in inputs]),
         )
-        return cursor.fetchall()
-
-
-def generate_informal(conn: Connection, batch_size: int = 50, limit_level: int | None = None, limit_num_per_level: int | None = None):
-    max_level: int
-    if limit_level is None:
-        with conn.cursor(row_factory=scalar_row) as cursor:
-            max_level = cursor.execute("SELECT MAX(level) FROM level").fetchone() or -1
-    else:
-        max_level = limit_level
-
-    tasks = []
-    with conn.cursor() as cursor, conn.cursor() as insert_cursor:
-        for level in range(max_level + 1):
-            query = """
-                SELECT s.name, s.kind, s.type, d.signature, d.value, d.docstring, m.docstring, d.module_name, d.index
-                FROM
-                    symbol s
-                    LEFT JOIN declaration d ON s.name = d.name
-                    INNER JOIN module m ON s.module_name = m.name
-                    INNER JOIN level l ON s.name = l.symbol_name
-                WHERE
-                    l.level = %s AND
-                    (NOT EXISTS(SELECT 1 FROM informal i WHERE i.symbol_name = s.name))
+    logger.info("recorded the input hash of %d translations", len(symbol_ids))
+
+
+def find_scheduled(conn: Connection, limit_level: int | None, limit_num_per_level: int | None) -> tuple[list[int], dict[int, set[int]]]:
+    """Symbols to be (re)considered for translation, and the dependencies of each among them."""
+    with conn.cursor() as cursor:
+        if limit_num_per_level:
+            cursor.execute(
+                """
+                SELECT symbol_id
+                FROM (
+                    SELECT l.symbol_id, l.level, ROW_NUMBER() OVER (PARTITION BY l.level ORDER BY i.symbol_id IS NOT NULL) AS n
+                    FROM level l LEFT JOIN informal i ON l.symbol_id = i.symbol_id
+                ) l
+                WHERE (%s::INTEGER IS NULL OR level <= %s) AND n <= %s
+                """,
+                (limit_level, limit_level, limit_num_per_level),
+            )
+        else:
+            cursor.execute("SELECT symbol_id FROM level WHERE %s::INTEGER IS NULL OR level <= %s", (limit_level, limit_level))
+        scheduled = [symbol_id for (symbol_id,) in cursor]
+        ids = set(scheduled)
+        dependencies: dict[int, set[int]] = {}
+        cursor.execute("SELECT source, target FROM dependency WHERE source <> target")
+        for source, target in cursor:
+            if source in ids and target in ids:
+                dependencies.setdefault(source, set()).add(target)
+    return scheduled, dependencies
+
+
+def generate_informal(
+    conn: Connection,
+    concurrency: int = 50,
+    limit_level: int | None = None,
+    limit_num_per_level: int | None = None,
+    prepare_size: int = 1000,
+):
+    """Translates every symbol whose translation input changed, with up to ``concurrency`` LLM requests in flight.
+
+    A symbol is started as soon as all of its dependencies are done, rather than after the whole previous level. The
+    inputs of up to ``prepare_size`` symbols that are ready are prepared at once.
+    """
+    scheduled, dependencies = find_scheduled(conn, limit_level, limit_num_per_level)
+    asyncio.run(_generate_informal(conn, concurrency, prepare_size, scheduled, dependencies))
+
+
+async def _generate_informal(conn: Connection, concurrency: int, prepare_size: int, scheduled: list[int], dependencies: dict[int, set[int]]):
+    env = TranslationEnvironment(model=os.environ["OPENAI_MODEL"])
+    dependents: dict[int, list[int]] = {}
+    for source, targets in dependencies.items():
+        for target in targets:
+            dependents.setdefault(target, []).append(source)
+    pending = {source: len(targets) for source, targets in dependencies.items()}
+    ready = deque(symbol_id for symbol_id in scheduled if symbol_id not in pending)
+    prepared: deque[tuple[int, TranslationInput | None]] = deque()
+    changed = asyncio.Condition()
+    in_flight = 0
+    preparing = False
+    stats = Counter()
+    start = time.monotonic()
+
+    async def translate_and_insert(symbol_id: int, data: TranslationInput | None):
+        if data is None:
+            stats["unchanged"] += 1
+            return
+        logger.info("translating %s", data.name)
+        result = await env.translate(data)
+        if result is None:
+            logger.warning("failed to translate %s", data.name)
+            stats["failed"] += 1
+            return
+        logger.info("translated %s", data.name)
+        stats["translated"] += 1
+        informal_name, informal_description = result
+        await asyncio.to_thread(
+            conn.execute,
             """
-            if limit_num_per_level:
-                cursor.execute(query + " LIMIT %s", (level, limit_num_per_level))
-            else:
-                cursor.execute(query, (level,))
-
-            while batch := cursor.fetchmany(batch_size):
-                env = TranslationEnvironment(model=os.environ["OPENAI_MODEL"])
-
-                async def translate_and_insert(name: LeanName, data: TranslationInput):
-                    result = await env.translate(data)
-                    if result is None:
-                        logger.warning("failed to translate %s", name)
-                    else:
-                        logger.info("translated %s", name)
-                        informal_name, informal_description = result
-                        insert_cursor.execute(
-                            """
-                            INSERT INTO informal (symbol_name, name, description)
-                            VALUES (%s, %s, %s)
-                            """,
-                            (Jsonb(name), informal_name, informal_description),
-                        )
-
-                tasks.clear()
-                for row in batch:
-                    name, kind, tp, signature, value, docstring, header, module_name, index = row
-
-                    logger.info("translating %s", name)
-                    if module_name is not None:
-                        neighbor = find_neighbor(conn, module_name, index)
-                    else:
-                        neighbor = []
-                    dependency = find_dependency(conn, name)
-
-                    ti = TranslationInput(
-                        name=name,
-                        signature=signature if signature is not None else tp,
-                        value=value,
-                        docstring=docstring,
-                        kind=kind,
-                        header=header,
-                        neighbor=neighbor,
-                        dependency=dependency,
-                    )
-                    tasks.append(translate_and_insert(name, ti))
-
-                async def wait_all():
-                    await asyncio.gather(*tasks)
-                    await env.client.close()
-
-                asyncio.run(wait_all())
+            INSERT INTO informal (symbol_id, name, description, input_hash)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (symbol_id) DO UPDATE SET name = EXCLUDED.name, description = EXCLUDED.description, input_hash = EXCLUDED.input_hash
+            """,
+            (symbol_id, informal_name, informal_description, data.input_hash),
+        )
+
+    def report():
+        rate = stats["translated"] / (time.monotonic() - start)
+        logger.info("%d/%d symbols done (%s), %.2f translations/s", stats.total(), len(scheduled), dict(stats), rate)
+
+    async def prepare(batch: list[int]):
+        nonlocal preparing
+        inputs = []
+        try:
+            inputs = await asyncio.to_thread(prepare_inputs, conn, batch)
+        finally:
+            async with changed:
+                preparing = False
+                prepared.extend(inputs)
+                changed.notify_all()
+
+    async def worker():
+        nonlocal in_flight, preparing
+        while True:
+            async with changed:
+                await changed.wait_for(lambda: prepared or (ready and not preparing) or not (in_flight or preparing))
+                if not prepared and not ready:
+                    return
+                if not prepared:
+                    # Prepared in a thread outside the lock, so that translations in flight go on meanwhile
+                    preparing = True
+                    batch = [ready.popleft() for _ in range(min(prepare_size, len(ready)))]
+                else:
+                    batch = None
+                    symbol_id, data = prepared.popleft()
+                    in_flight += 1
+            if batch is not None:
+                await prepare(batch)
+                continue
+            try:
+                await translate_and_insert(symbol_id, data)
+            finally:
+                async with changed:
+                    in_flight -= 1
+                    # Dependents of a failed symbol are still translated, as they were when going level by level
+                    for dependent in dependents.pop(symbol_id, []):
+                        pending[dependent] -= 1
+                        if not pending[dependent]:
+                            ready.append(dependent)
+                    changed.notify_all()
+            if stats.total() % 100 == 0 or stats.total() == len(scheduled):
+                report()
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(concurrency):
+                tg.create_task(worker())
+    finally:
+        if env.cache is not None:
+            logger.info("LLM cache: %d hits, %d misses (%.1f%% hit rate)", env.cache.hits, env.cache.misses, 100 * env.cache.hit_rate)
+        await env.close()
@@ -1,11 +1,18 @@
+import json
 import logging
 import os
-from collections.abc import Iterable
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 from pathlib import Path
+from typing import LiteralString
+
+import numpy as np
 
 from jixia import LeanProject
-from jixia.structs import LeanName, Symbol, Declaration, is_internal, StringRange
-from psycopg import Connection
+from jixia.structs import LeanName, Symbol, Declaration, is_internal, is_prefix_of, pp_name, StringRange
+from psycopg import Connection, Cursor, sql
 from psycopg.types.json import Jsonb
 from psycopg.types.range import Range
 
@@ -32,140 +39,257 @@ def _get_range(declaration: Declaration):
     else:
         return None
 
-def load_data(project: LeanProject, prefixes: list[LeanName], conn: Connection):
-    def load_module(data: Iterable[LeanName], base_dir: Path):
-        values = ((Jsonb(m), project.path_of_module(m, base_dir).read_bytes(), project.load_module_info(m).docstring) for m in data)
-        cursor.executemany(
+def _fetch_ints(cursor: Cursor, query: LiteralString, *columns: str) -> np.ndarray:
+    """Rows of non-null ``INTEGER`` columns of a query as an array.
+
+    Each column is aggregated into a single ``BYTEA`` of big-endian integers, which is much faster to transfer and
+    decode than rows one at a time.
+    """
+    aggregates = sql.SQL(", ").join(sql.SQL("string_agg(int4send({}), '')").format(sql.Identifier(c)) for c in columns)
+    cursor.execute(sql.SQL("SELECT {} FROM ({}) q").format(aggregates, sql.SQL(query)))
+    row = cursor.fetchone()
+    return np.stack([np.frombuffer(data or b"", dtype=">i4").astype(np.int64) for data in row], axis=1)
+
+
+def compute_levels(ids: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Level of each symbol in ``ids``, given ``(source, target)`` dependency edges: 0 for symbols without dependencies,
+    and one more than the highest level among their dependencies otherwise.
+
+    Self-dependencies are ignored. Symbols on a dependency cycle, or depending on one, get -1. This is Kahn's
+    algorithm, one level per round, where each round handles the dependents of the previous level with array operations.
+    """
+    n = len(ids)
+    order = np.argsort(ids)
+    source = order[np.searchsorted(ids, edges[:, 0], sorter=order)]
+    target = order[np.searchsorted(ids, edges[:, 1], sorter=order)]
+    # Each edge once, whether it is a dependency on the type, the value or both
+    edge = np.unique(source[source != target] * n + target[source != target])
+    source, target = edge // n, edge % n
+    remaining = np.bincount(source, minlength=n)
+    # Dependents of each symbol, as consecutive runs of ``dependents``
+    dependents = source[np.argsort(target, kind="stable")]
+    start = np.concatenate([[0], np.cumsum(np.bincount(target, minlength=n))])
+
+    levels = np.full(n, -1, dtype=np.int64)
+    frontier = np.flatnonzero(remaining == 0)
+    level = 0
+    while len(frontier):
+        levels[frontier] = level
+        lengths = start[frontier + 1] - start[frontier]
+        offsets = np.repeat(start[frontier] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        done = dependents[offsets]
+        remaining -= np.bincount(done, minlength=n)
+        frontier = np.unique(done[remaining[done] == 0])
+        level += 1
+    return levels
+
+
+STAGING: list[LiteralString] = [
+    "CREATE TEMPORARY TABLE module_staging (name JSONB, content BYTEA, docstring TEXT) ON COMMIT DROP",
+    "CREATE TEMPORARY TABLE symbol_staging (name JSONB, module_name JSONB, kind symbol_kind, type TEXT, is_prop BOOLEAN, ordinal INTEGER) ON COMMIT DROP",
+    "CREATE TEMPORARY TABLE dependency_staging (source JSONB, target JSONB, on_type BOOLEAN) ON COMMIT DROP",
+    """
+    CREATE TEMPORARY TABLE declaration_staging (
+        module_name JSONB, index INTEGER, name JSONB, visible BOOLEAN, docstring TEXT, kind declaration_kind, signature TEXT, value TEXT, range INT8RANGE,
+        ordinal INTEGER
+    ) ON COMMIT DROP
+    """,
+]
+
+
+def _symbol_rows(project: LeanProject, module: LeanName) -> tuple[list[tuple], list[tuple]]:
+    symbols = [s for s in project.load_info(module, Symbol) if not is_internal(s.name)]
+    rows = [(json.dumps(s.name), json.dumps(module), s.kind, s.type_readable if s.type_readable is not None else s.type, s.is_prop) for s in symbols]
+    edges = []
+    for s in symbols:
+        edges.extend((json.dumps(s.name), json.dumps(t), True) for t in s.type_references if not is_internal(t))
+        if s.value_references is not None:
+            edges.extend((json.dumps(s.name), json.dumps(t), False) for t in s.value_references if not is_internal(t))
+    return rows, edges
+
+
+def _declaration_rows(project: LeanProject, module: LeanName, module_content: bytes) -> list[tuple]:
+    rows = []
+    for index, decl in enumerate(project.load_info(module, Declaration)):
+        if is_internal(decl.name) or decl.kind == "proofWanted":
+            continue
+        rows.append((
+            json.dumps(module),
+            index,
+            json.dumps(decl.name) if decl.kind != "example" else None,
+            decl.modifiers.visibility != "private" and decl.kind != "example",
+            decl.modifiers.docstring,
+            decl.kind,
+            _get_signature(decl, module_content),
+            _get_value(decl, module_content),
+            _get_range(decl),
+        ))
+    return rows
+
+
+def _module_rows(project: LeanProject, module: LeanName, base_dir: Path) -> tuple[LeanName, list[tuple], list[tuple], list[tuple], list[tuple]]:
+    """Rows of the staging tables for one module, built in a worker process.
+
+    Names are serialized to JSON text here, which ``COPY`` takes for ``JSONB`` columns, to spare the writer the work.
+    """
+    content = project.path_of_module(module, base_dir).read_bytes()
+    symbols, edges = _symbol_rows(project, module)
+    declarations = _declaration_rows(project, module, content)
+    return module, [(json.dumps(module), content, project.load_module_info(module).docstring)], symbols, edges, declarations
+
+
+def _parse_modules(project: LeanProject, modules: list[tuple[LeanName, Path]], processes: int | None) -> Iterator[tuple[int, tuple]]:
+    """Position in ``modules`` and results of :func:`_module_rows` of every module, in the order they are ready."""
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes) as executor:
+        # A bounded number of modules in flight, so that parsed rows do not pile up when the writer is slower
+        todo = iter(enumerate(modules))
+        running = {executor.submit(_module_rows, project, m, d): i for i, (m, d) in islice(todo, 2 * processes)}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            running.update({executor.submit(_module_rows, project, m, d): i for i, (m, d) in islice(todo, len(done))})
+            for future in done:
+                yield running.pop(future), future.result()
+
+
+def load_data(project: LeanProject, prefixes: list[LeanName], conn: Connection, processes: int | None = None):
+    """Loads the jixia output of the modules matching ``prefixes`` into the database, replacing what they had before.
+
+    The output of each module is parsed in one of ``processes`` worker processes (one per core by default). Its rows
+    are streamed with ``COPY`` into temporary staging tables by this process, and then merged into the real ones with
+    one statement per table, where names are resolved to symbol ids by joins. As when modules were loaded one by one, a
+    module found both in the project and in the Lean sources is taken from the project, and a symbol defined in several
+    modules from the first of them in load order, whichever order they are parsed in.
+    """
+
+    def stage(rows_of_module: tuple, ordinal: int):
+        _, modules, symbols, edges, declarations = rows_of_module
+        for query, rows in (
+            ("COPY module_staging (name, content, docstring) FROM STDIN", modules),
+            ("COPY symbol_staging (name, module_name, kind, type, is_prop, ordinal) FROM STDIN", [(*row, ordinal) for row in symbols]),
+            ("COPY dependency_staging (source, target, on_type) FROM STDIN", edges),
+            ("COPY declaration_staging (module_name, index, name, visible, docstring, kind, signature, value, range, ordinal) FROM STDIN", [(*row, ordinal) for row in declarations]),
+        ):
+            with cursor.copy(query) as copy:
+                for row in rows:
+                    copy.write_row(row)
+
+    def merge(modules: list[LeanName]):
+        module_names = [Jsonb(m) for m in modules]
+        for table in "module_staging", "symbol_staging", "dependency_staging", "declaration_staging":
+            cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        cursor.execute(
+            """
+            INSERT INTO module (name, content, docstring) SELECT name, content, docstring FROM module_staging
+            ON CONFLICT (name) DO UPDATE SET content = EXCLUDED.content, docstring = EXCLUDED.docstring
+            """
+        )
+        cursor.execute(
+            """
+            SELECT name, COUNT(*) OVER () FROM symbol_staging GROUP BY name HAVING COUNT(DISTINCT ordinal) > 1 LIMIT 10
             """
-            INSERT INTO module (name, content, docstring) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING
-            """,
-            values,
         )
+        if duplicates := cursor.fetchall():
+            examples = ", ".join(pp_name(name) for name, _ in duplicates)
+            logger.warning("%d symbols are defined in several modules and are taken from the first one loaded, e.g., %s", duplicates[0][1], examples)
+        # Existing symbols are updated in place, so that they keep their id and everything derived from it
+        cursor.execute(
+            """
+            INSERT INTO symbol (name, module_name, kind, type, is_prop)
+                SELECT DISTINCT ON (name) name, module_name, kind, type, is_prop FROM symbol_staging ORDER BY name, ordinal
+            ON CONFLICT (name) DO UPDATE SET module_name = EXCLUDED.module_name, kind = EXCLUDED.kind, type = EXCLUDED.type, is_prop = EXCLUDED.is_prop
+            """
+        )
+        logger.info("loaded %d symbols", cursor.rowcount)
+        remove_deleted(modules)
 
-    def load_symbol(module: LeanName):
-        symbols = [s for s in project.load_info(module, Symbol) if not is_internal(s.name)]
-        values = ((Jsonb(s.name), Jsonb(module), s.kind, s.type_readable if s.type_readable is not None else s.type, s.is_prop) for s in symbols)
-        cursor.executemany(
+        cursor.execute("DELETE FROM dependency WHERE source IN (SELECT id FROM symbol WHERE module_name = ANY(%s::jsonb[]))", (module_names,))
+        cursor.execute(
+            """
+            INSERT INTO dependency (source, target, on_type)
+                SELECT s.id, t.id, e.on_type
+                FROM
+                    dependency_staging e
+                    INNER JOIN symbol s ON s.name = e.source
+                    INNER JOIN symbol t ON t.name = e.target
+            ON CONFLICT DO NOTHING
             """
-            INSERT INTO symbol (name, module_name, kind, type, is_prop) VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING
-            """,
-            values,
         )
-        for s in symbols:
-            values = (
-                {
-                    "source": Jsonb(s.name),
-                    "target": Jsonb(t),
-                }
-                for t in s.type_references
-                if not is_internal(t)
-            )
-            cursor.executemany(
-                """
-                INSERT INTO dependency (source, target, on_type)
-                    SELECT %(source)s, %(target)s, TRUE
-                    WHERE EXISTS(SELECT 1 FROM symbol WHERE name = %(target)s)
-                ON CONFLICT DO NOTHING
-                """,
-                values,
-            )
-
-            if s.value_references is not None:
-                values = (
-                    {
-                        "source": Jsonb(s.name),
-                        "target": Jsonb(t),
-                    }
-                    for t in s.value_references
-                    if not is_internal(t)
-                )
-                cursor.executemany(
-                    """
-                    INSERT INTO dependency (source, target, on_type)
-                        SELECT %(source)s, %(target)s, FALSE
-                        WHERE EXISTS(SELECT 1 FROM symbol WHERE name = %(target)s)
-                    ON CONFLICT DO NOTHING
-                    """,
-                    values,
-                )
-
-    def load_declaration(module_name: LeanName):
-        declarations = project.load_info(module_name, Declaration)
+        logger.info("loaded %d dependencies", cursor.rowcount)
+
+        # Indices shift when a module changes, so its declarations are reloaded as a whole
+        cursor.execute("DELETE FROM declaration WHERE module_name = ANY(%s::jsonb[])", (module_names,))
         cursor.execute(
             """
-            SELECT content FROM module WHERE name = %s
-            """,
-            (Jsonb(module_name),),
+            INSERT INTO declaration (module_name, index, symbol_id, visible, docstring, kind, signature, value, range)
+                SELECT DISTINCT ON (s.id) d.module_name, d.index, s.id, d.visible, d.docstring, d.kind, d.signature, d.value, d.range
+                FROM declaration_staging d INNER JOIN symbol s ON s.name = d.name
+                ORDER BY s.id, d.ordinal
+            ON CONFLICT DO NOTHING
+            """
         )
-        module = cursor.fetchone()
-        if module is None:
-            logger.warn("couldn't find a module with name '%s'", Jsonb(module_name))
-            return
-        (module_content,) = module
-
-        db_declarations = []
-        for index, decl in enumerate(declarations):
-            if is_internal(decl.name) or decl.kind == "proofWanted":
-                continue
-            db_declarations.append({
-                "module_name": Jsonb(module_name),
-                "index"      : index,
-                "name"       : Jsonb(decl.name) if decl.kind != "example" else None,
-                "visible"    : decl.modifiers.visibility != "private" and decl.kind != "example",
-                "docstring"  : decl.modifiers.docstring,
-                "kind"       : decl.kind,
-                "signature"  : _get_signature(decl, module_content),
-                "value"      : _get_value(decl, module_content),
-                "range"      : _get_range(decl),
-            })
-        cursor.executemany(
+        logger.info("loaded %d declarations", cursor.rowcount)
+
+    def remove_deleted(modules: list[LeanName]):
+        # Deleting a module or a symbol also deletes its declarations, dependencies, levels and informal descriptions
+        cursor.execute("SELECT name FROM module")
+        loaded = set(map(tuple, modules))
+        removed = [Jsonb(m) for (m,) in cursor.fetchall() if any(is_prefix_of(p, m) for p in prefixes) and tuple(m) not in loaded]
+        cursor.execute("DELETE FROM module WHERE name = ANY(%s::jsonb[])", (removed,))
+        logger.info("removed %d modules", cursor.rowcount)
+
+        cursor.execute(
             """
-            INSERT INTO declaration (module_name, index, name, visible, docstring, kind, signature, value)
-            SELECT %(module_name)s, %(index)s, %(name)s, %(visible)s, %(docstring)s, %(kind)s, %(signature)s, %(value)s
-                WHERE EXISTS(SELECT 1 FROM symbol WHERE name = %(name)s)
-            ON CONFLICT DO NOTHING 
+            DELETE FROM symbol s
+            WHERE s.module_name = ANY(%s::jsonb[]) AND NOT EXISTS (SELECT 1 FROM symbol_staging l WHERE l.name = s.name)
             """,
-            db_declarations,
+            ([Jsonb(m) for m in modules],),
         )
+        logger.info("removed %d symbols", cursor.rowcount)
 
     def topological_sort():
         logger.info("performing topological sort")
-        cursor.execute("""
-            INSERT INTO level (symbol_name, level)
-                SELECT name, 0
-                FROM symbol v
-                WHERE NOT EXISTS (SELECT 1 FROM dependency e WHERE e.source = v.name)
-        """)
-        while cursor.rowcount:
-            logger.info("topological sort: %d rows affected", cursor.rowcount)
-            # Find all nodes whose direct predecessors have already been assigned a level
-            cursor.execute("""
-                INSERT INTO level (symbol_name, level)
-                    SELECT e.source AS symbol_name, MAX(l.level) + 1 AS level
-                    FROM
-                        dependency e LEFT JOIN level l ON e.target = l.symbol_name
-                    WHERE NOT EXISTS(SELECT 1 FROM level l WHERE l.symbol_name = e.source)
-                    GROUP BY e.source
-                    HAVING
-                        EVERY(l.level IS NOT NULL) = TRUE
-            """)
-
-    with conn.cursor() as cursor:
-        lean_sysroot = Path(os.environ["LEAN_SYSROOT"])
-        lean_src = lean_sysroot / "src" / "lean"
-        all_modules = []
-        for d in project.root, lean_src:
-            results = project.batch_run_jixia(
-                base_dir=d,
-                prefixes=prefixes,
-                plugins=["module", "declaration", "symbol"],
-            )
-            modules = [r[0] for r in results]
-            load_module(modules, d)
-            all_modules += modules
-
-        for m in all_modules:
-            load_symbol(m)
-        for m in all_modules:
-            load_declaration(m)
+        ids = _fetch_ints(cursor, "SELECT id FROM symbol", "id")[:, 0]
+        edges = _fetch_ints(cursor, "SELECT source, target FROM dependency", "source", "target")
+        levels = compute_levels(ids, edges)
+        unresolved = ids[levels < 0]
+        if len(unresolved):
+            cursor.execute("SELECT name FROM symbol WHERE id = ANY(%s) LIMIT 10", (unresolved.tolist(),))
+            examples = ", ".join(pp_name(name) for (name,) in cursor.fetchall())
+            logger.warning("%d symbols are on or depend on a dependency cycle and get no level, e.g., %s", len(unresolved), examples)
+        cursor.execute("DELETE FROM level")
+        with cursor.copy("COPY level (symbol_id, level) FROM STDIN") as copy:
+            for symbol_id, level in zip(ids.tolist(), levels.tolist()):
+                if level >= 0:
+                    copy.write_row((symbol_id, level))
+        logger.info("topological sort: %d symbols in %d levels", len(ids) - len(unresolved), levels.max(initial=-1) + 1)
+
+    lean_sysroot = Path(os.environ["LEAN_SYSROOT"])
+    lean_src = lean_sysroot / "src" / "lean"
+    all_modules = []
+    for d in project.root, lean_src:
+        results = project.batch_run_jixia(
+            base_dir=d,
+            prefixes=prefixes,
+            plugins=["module", "declaration", "symbol"],
+        )
+        all_modules += [(r[0], d) for r in results]
+    # A module in both is loaded from the first, the project
+    unique = {}
+    for m, d in all_modules:
+        unique.setdefault(tuple(m), (m, d))
+    all_modules = list(unique.values())
+
+    # Loading into an existing database updates it; the search server keeps seeing the previous contents until the end.
+    # The transaction is only opened once jixia is done, so that it does not sit idle through the hours jixia can take.
+    with conn.transaction(), conn.cursor() as cursor:
+        for s in STAGING:
+            cursor.execute(s)
+        start = time.monotonic()
+        for i, (ordinal, rows_of_module) in enumerate(_parse_modules(project, all_modules, processes), 1):
+            stage(rows_of_module, ordinal)
+            module, _, symbols, _, declarations = rows_of_module
+            rate = i / (time.monotonic() - start)
+            logger.info("staged %s (%d symbols, %d declarations), %d/%d modules, %.1f modules/s", pp_name(module), len(symbols), len(declarations), i, len(all_modules), rate)
+        merge([m for m, _ in all_modules])
         topological_sort()
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """Chat completion answers in SQLite, keyed by the model and a hash of the messages.
+
+    Once more than ``capacity`` answers are stored, the least recently used tenth of them is evicted.
+    """
+
+    def __init__(self, path: str, capacity: int, log_every: int = 100):
+        self.capacity = capacity
+        self.log_every = log_every
+        self.hits = 0
+        self.misses = 0
+        # Every access is a short transaction of its own, and several processes may share the file
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS answer (key TEXT PRIMARY KEY, answer TEXT NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS answer_used ON answer (used)")
+        (self.size,) = self.db.execute("SELECT COUNT(*) FROM answer").fetchone()
+
+    @staticmethod
+    def key(model: str, messages: list[dict]) -> str:
+        return hashlib.sha256(json.dumps([model, messages]).encode()).hexdigest()
+
+    def get(self, model: str, messages: list[dict]) -> str | None:
+        key = self.key(model, messages)
+        row = self.db.execute("UPDATE answer SET used = ? WHERE key = ? RETURNING answer", (time.time(), key)).fetchone()
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if (self.hits + self.misses) % self.log_every == 0:
+            logger.info("LLM cache: %d hits, %d misses (%.1f%% hit rate)", self.hits, self.misses, 100 * self.hit_rate)
+        return None if row is None else row[0]
+
+    def put(self, model: str, messages: list[dict], answer: str):
+        cursor = self.db.execute("INSERT OR IGNORE INTO answer VALUES (?, ?, ?)", (self.key(model, messages), answer, time.time()))
+        self.size += cursor.rowcount
+        if self.size > self.capacity:
+            evicted = self.size - self.capacity * 9 // 10
+            self.db.execute("DELETE FROM answer WHERE key IN (SELECT key FROM answer ORDER BY used LIMIT ?)", (evicted,))
+            (self.size,) = self.db.execute("SELECT COUNT(*) FROM answer").fetchone()
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(1, self.hits + self.misses)
+
+    def close(self):
+        self.db.close()
+
+
+def open_llm_cache() -> LLMCache | None:
+    if path := os.environ.get("LLM_CACHE_PATH"):
+        return LLMCache(path, int(os.environ.get("LLM_CACHE_SIZE", 100_000)))
+    return None
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import mmap
+import shutil
+import tempfile
+from array import array
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from jixia.structs import LeanName
+from psycopg import Connection
+
+logger = logging.getLogger(__name__)
+
+# File layout: MAGIC, the header length as a little-endian uint64, the JSON header, then the sections it lists,
+# each aligned to ALIGNMENT bytes. String columns are stored as an offsets array into a single blob.
+MAGIC = b"LSRECS01"
+ALIGNMENT = 64
+
+STRING_COLUMNS = ["module_name", "kind", "name", "signature", "type", "value", "docstring", "informal_name", "informal_description"]
+INT_COLUMNS = ["index", "start", "stop"]
+JSON_COLUMNS = {"module_name", "name"}
+NULLABLE_COLUMNS = {"start", "stop", "value", "docstring"}
+
+
+def _align(size: int) -> int:
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def _id_key(module_name: LeanName, index: int) -> str:
+    return f"{json.dumps(list(module_name))}:{index}"
+
+
+def _name_key(name: LeanName) -> str:
+    return json.dumps(list(name))
+
+
+def export_records(conn: Connection, path: str):
+    path = Path(path)
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmp:
+        blobs = {c: open(Path(tmp) / c, "wb+") for c in STRING_COLUMNS}
+        offsets = {c: array("Q", [0]) for c in STRING_COLUMNS}
+        ints = {c: array("q") for c in INT_COLUMNS}
+        nulls = {c: bytearray() for c in NULLABLE_COLUMNS}
+        id_hashes = array("Q")
+        name_hashes = array("Q")
+
+        columns = INT_COLUMNS + STRING_COLUMNS
+        with conn.transaction(), conn.cursor("export_records") as cursor:
+            # The version is read from the snapshot the records are
+            conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            version = _index_version(conn)
+            cursor.execute(f"SELECT {', '.join(columns)} FROM record")
+            for row in cursor:
+                row = dict(zip(columns, row))
+                for c in NULLABLE_COLUMNS:
+                    nulls[c].append(row[c] is None)
+                for c in INT_COLUMNS:
+                    ints[c].append(-1 if row[c] is None else row[c])
+                for c in STRING_COLUMNS:
+                    value = row[c]
+                    if value is not None:
+                        blobs[c].write((json.dumps(value) if c in JSON_COLUMNS else value).encode())
+                    offsets[c].append(blobs[c].tell())
+                id_hashes.append(_hash(_id_key(row["module_name"], row["index"])))
+                name_hashes.append(_hash(_name_key(row["name"])))
+
+        count = len(id_hashes)
+        sections: dict[str, Any] = {}
+        for c in INT_COLUMNS:
+            sections[c] = np.frombuffer(ints[c], dtype=np.int64)
+        for c in STRING_COLUMNS:
+            sections[f"{c}.offsets"] = np.frombuffer(offsets[c], dtype=np.uint64)
+            sections[f"{c}.data"] = blobs[c]
+        for c in NULLABLE_COLUMNS:
+            sections[f"{c}.null"] = np.frombuffer(nulls[c], dtype=np.bool_)
+        for key, hashes in ("id", id_hashes), ("name", name_hashes):
+            hashes = np.frombuffer(hashes, dtype=np.uint64)
+            order = np.argsort(hashes, kind="stable")
+            sections[f"{key}.hash"] = hashes[order]
+            sections[f"{key}.row"] = order.astype(np.uint32)
+
+        layout = {}
+        offset = 0
+        for name, section in sections.items():
+            size = section.nbytes if isinstance(section, np.ndarray) else section.tell()
+            dtype = section.dtype.str if isinstance(section, np.ndarray) else "|u1"
+            layout[name] = [offset, dtype, size]
+            offset += _align(size)
+        header = json.dumps({"count": count, "version": version, "sections": layout}).encode()
+        base = _align(len(MAGIC) + 8 + len(header))
+
+        with open(Path(tmp) / "records", "wb") as fp:
+            fp.write(MAGIC)
+            fp.write(len(header).to_bytes(8, "little"))
+            fp.write(header)
+            for name, section in sections.items():
+                fp.seek(base + layout[name][0])
+                if isinstance(section, np.ndarray):
+                    fp.write(section.tobytes())
+                else:
+                    section.seek(0)
+                    shutil.copyfileobj(section, fp)
+                    section.close()
+            fp.truncate(base + offset)
+        # Replace atomically, so that running servers keep the old file mapped
+        (Path(tmp) / "records").replace(path)
+    logger.info("exported %d records to %s", count, path)
+
+
+def _index_version(conn: Connection) -> int:
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM index_version")
+        return cursor.fetchone()[0]
+
+
+class RecordStore:
+    """Read-only, memory-mapped view of a file written by :func:`export_records`.
+
+    Pages are shared through the OS page cache, so every server process can map the same file.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a record store")
+        header_size = int.from_bytes(self.mm[len(MAGIC) : len(MAGIC) + 8], "little")
+        header = json.loads(self.mm[len(MAGIC) + 8 : len(MAGIC) + 8 + header_size])
+        base = _align(len(MAGIC) + 8 + header_size)
+        self.count: int = header["count"]
+        self.version: int = header["version"]
+        self.sections = {name: np.frombuffer(self.mm, dtype=np.dtype(dtype), count=size // np.dtype(dtype).itemsize, offset=base + offset) for name, (offset, dtype, size) in header["sections"].items()}
+
+    def close(self):
+        self.sections.clear()
+        self.mm.close()
+
+    def _string(self, column: str, row: int) -> str:
+        offsets = self.sections[f"{column}.offsets"]
+        data = self.sections[f"{column}.data"]
+        start, stop = int(offsets[row]), int(offsets[row + 1])
+        return str(data[start:stop], "utf-8")
+
+    def row(self, row: int, columns: Iterable[str] | None = None) -> dict[str, Any]:
+        """The columns of the ``row``-th record, only those in ``columns`` if given; the others are not read at all."""
+        columns = INT_COLUMNS + STRING_COLUMNS if columns is None else columns
+        ret = {}
+        for c in columns:
+            if c in NULLABLE_COLUMNS and self.sections[f"{c}.null"][row]:
+                ret[c] = None
+            elif c in INT_COLUMNS:
+                ret[c] = int(self.sections[c][row])
+            elif c in JSON_COLUMNS:
+                ret[c] = json.loads(self._string(c, row))
+            else:
+                ret[c] = self._string(c, row)
+        return ret
+
+    def _find(self, key: str, kind: str, matches) -> int | None:
+        hashes = self.sections[f"{kind}.hash"]
+        rows = self.sections[f"{kind}.row"]
+        h = np.uint64(_hash(key))
+        i = int(np.searchsorted(hashes, h))
+        # Hash collisions are resolved by comparing the stored key
+        while i < len(hashes) and hashes[i] == h:
+            if matches(int(rows[i])):
+                return int(rows[i])
+            i += 1
+        return None
+
+    def find(self, module_name: LeanName, index: int) -> int | None:
+        def matches(row: int) -> bool:
+            return self.sections["index"][row] == index and json.loads(self._string("module_name", row)) == list(module_name)
+
+        return self._find(_id_key(module_name, index), "id", matches)
+
+    def find_name(self, name: LeanName) -> int | None:
+        return self._find(_name_key(name), "name", lambda row: json.loads(self._string("name", row)) == list(name))
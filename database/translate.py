@@ -1,6 +1,9 @@
 import asyncio
+import hashlib
+import json
 import logging
 import os
+import random
 import re
 from dataclasses import dataclass
 from json import JSONDecodeError
@@ -8,10 +11,15 @@ from json import JSONDecodeError
 import jinja2
 from jinja2 import Environment, FileSystemLoader
 from jixia.structs import DeclarationKind, LeanName, pp_name
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
+
+from .llm_cache import open_llm_cache
 
 logger = logging.getLogger(__name__)
 
+MAX_RATE_LIMIT_RETRIES = 10
+MAX_BACKOFF = 60.0
+
 
 @dataclass
 class TranslatedItem:
@@ -33,6 +41,13 @@ class TranslationInput:
     neighbor: list[TranslatedItem]
     dependency: list[TranslatedItem]
 
+    @property
+    def input_hash(self) -> str:
+        """Hash of what the translation depends on, except for neighbors, which shift whenever their module changes."""
+        dependency = sorted((pp_name(d.name), d.informal_name or "", d.informal_description or "") for d in self.dependency)
+        content = [self.name, self.signature, self.value, self.docstring, self.kind, self.header, dependency]
+        return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
     @property
     def value_matters(self):
         return self.kind in ["classInductive", "definition", "inductive", "structure"]
@@ -48,6 +63,7 @@ class TranslationEnvironment:
         self.env.filters["pp_name"] = pp_name
         self.template = {kind: self.env.get_template(f"{kind}.md.j2") for kind in ["theorem", "definition", "instance"]}
         self.client = AsyncOpenAI()
+        self.cache = open_llm_cache()
         self.model = model
         self.pattern_name = re.compile(r"\*\*Informal name:?\*\*\s*(.*)")
         self.pattern_description = re.compile(
@@ -55,6 +71,14 @@ class TranslationEnvironment:
             re.DOTALL,
         )
 
+    def parse(self, answer: str) -> tuple[str, str] | None:
+        try:
+            name = self.pattern_name.search(answer).group(1)
+            description = self.pattern_description.search(answer).group(1)
+        except AttributeError:  # unable to parse the result, at least one of the regex did not match
+            return None
+        return name.strip(), description.strip()
+
     async def translate(self, data: TranslationInput) -> tuple[str, str] | None:
         if data.kind == "instance":
             kind = "instance"
@@ -64,26 +88,45 @@ class TranslationEnvironment:
         if os.environ["DRY_RUN"] == "true":
             logger.info("DRY_RUN:skipped informalization: %s", data.name)
             return "Fake Name", f"Fake Description\nPrompt:\n{data}"
-        for _ in range(5):
+        messages = [{"role": "user", "content": prompt}]
+        # Only answers that could be parsed are cached
+        if self.cache is not None and (answer := self.cache.get(self.model, messages)) is not None:
+            return self.parse(answer)
+        attempts = 0
+        rate_limited = 0
+        while attempts < 5:
             try:
                 response = await self.client.chat.completions.create(
                     model=self.model,
-                    messages=[
-                        {"role": "user", "content": prompt},
-                    ],
+                    messages=messages,
                     # ___Why don't we use `response_format={ 'type': 'json_object' }`?
                     #    DeepSeek support for json is rather limited at the moment, in our case it will be raising parse errors on LaTeX escape characters.
                     stream=False,
                 )
+            except RateLimitError:
+                # Backing off does not use up an attempt, as it is expected with many requests in flight
+                if rate_limited == MAX_RATE_LIMIT_RETRIES:
+                    break
+                delay = min(MAX_BACKOFF, 2**rate_limited) * random.uniform(0.5, 1.5)
+                rate_limited += 1
+                logger.info("while translating %s: rate limited; retrying in %.1fs", data.name, delay)
+                await asyncio.sleep(delay)
+                continue
             except JSONDecodeError:  # DeepSeek API is not available right now
                 logger.info("while translating %s: service unavailable; retrying", data.name)
+                attempts += 1
                 await asyncio.sleep(1)
                 continue
             answer = response.choices[0].message.content
-            try:
-                name = self.pattern_name.search(answer).group(1)
-                description = self.pattern_description.search(answer).group(1)
-            except AttributeError:  # unable to parse the result, at least one of the regex did not match
+            if (result := self.parse(answer)) is None:
                 logger.info("while translating %s: unable to parse the result; retrying", data.name)
+                attempts += 1
                 continue
-            return name.strip(), description.strip()
+            if self.cache is not None:
+                self.cache.put(self.model, messages, answer)
+            return result
+
+    async def close(self):
+        await self.client.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,496 @@
+import os
+import shutil
+from abc import ABC, abstractmethod
+from collections.abc import Hashable, Iterable, Iterator
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+
+import chromadb
+import numpy as np
+from chromadb import Embeddings
+from chromadb.api.client import SharedSystemClient
+from jixia.structs import LeanName, is_prefix_of, parse_name, pp_name
+
+from .embedding import DIMENSION
+
+Hit = tuple[str, float]
+
+
+def record_id(module_name: LeanName, index: int) -> str:
+    return f"{pp_name(module_name)}:{index}"
+
+
+def parse_record_id(doc_id: str) -> tuple[LeanName, int]:
+    module_name, _, index = doc_id.rpartition(":")
+    return parse_name(module_name), int(index)
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """Restricts a search to declarations in a module under any of ``module_prefix``, and of any of ``kind``.
+
+    An empty tuple puts no restriction on that field.
+    """
+
+    module_prefix: tuple[tuple[str | int, ...], ...] = ()
+    kind: tuple[str, ...] = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.module_prefix or self.kind)
+
+    def matches_module(self, module_name: LeanName) -> bool:
+        return not self.module_prefix or any(is_prefix_of(p, module_name) for p in self.module_prefix)
+
+    def matches_kind(self, kind: str) -> bool:
+        return not self.kind or kind in self.kind
+
+
+def _codes(values: Iterable[Hashable]) -> tuple[list, np.ndarray]:
+    table = {}
+    codes = np.fromiter((table.setdefault(v, len(table)) for v in values), dtype=np.int32)
+    return list(table), codes
+
+
+class RowMetadata:
+    """Module and kind of each row as integer codes, so that a :class:`SearchFilter` is checked once per distinct value."""
+
+    def __init__(self, modules: Iterable[LeanName], kinds: Iterable[str]):
+        self.modules, self.module_codes = _codes(tuple(m) for m in modules)
+        self.kinds, self.kind_codes = _codes(kinds)
+
+    def mask(self, where: SearchFilter) -> np.ndarray:
+        mask = np.ones(len(self.module_codes), dtype=np.bool_)
+        if where.module_prefix:
+            mask &= np.isin(self.module_codes, [i for i, m in enumerate(self.modules) if where.matches_module(m)])
+        if where.kind:
+            mask &= np.isin(self.kind_codes, [i for i, k in enumerate(self.kinds) if where.matches_kind(k)])
+        return mask
+
+
+class VectorBackend(ABC):
+    """Storage and nearest-neighbour search for declaration embeddings, keyed by :func:`record_id`.
+
+    Each embedding is stored with the kind of its declaration, so that searches can be restricted by a :class:`SearchFilter`
+    inside the index rather than by over-fetching, and with a hash of the embedded document, so that an index can be
+    updated with only the documents that changed. Distances are cosine distances, i.e., ``1 - cos``.
+    """
+
+    @abstractmethod
+    def add(self, ids: list[str], embeddings: Embeddings, kinds: list[str], hashes: list[str]): ...
+
+    @abstractmethod
+    def delete(self, ids: list[str]): ...
+
+    @abstractmethod
+    def embeddings(self, ids: list[str]) -> np.ndarray:
+        """Stored embeddings of ``ids``, in order."""
+
+    @abstractmethod
+    def query(self, embeddings: Embeddings, num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]: ...
+
+    @abstractmethod
+    def count(self) -> int: ...
+
+    @abstractmethod
+    def hashes(self) -> dict[str, str]:
+        """Document hash of every stored embedding by id; empty for embeddings added without one."""
+
+    @abstractmethod
+    def set_metadata(self, ids: list[str], kinds: list[str], hashes: list[str]):
+        """Records the kind and document hash of stored embeddings, such as those added before they were stored."""
+
+    @abstractmethod
+    def reopen(self) -> "VectorBackend":
+        """The index as it now is on disk, with what other processes wrote to it since this one was opened."""
+
+    def compact(self):
+        """Reclaims the space of deleted embeddings, for backends that do not on their own."""
+
+
+class ChromaBackend(VectorBackend):
+    def __init__(self, path: str, create: bool = False):
+        self.path = path
+        self.client = chromadb.PersistentClient(path)
+        if create:
+            self.collection = self.client.get_or_create_collection(
+                name="leansearch",
+                metadata={"hnsw:space": "cosine"},
+                embedding_function=None,
+            )
+        else:
+            self.collection = self.client.get_collection(name="leansearch", embedding_function=None)
+
+    @staticmethod
+    def _metadatas(ids: list[str], kinds: list[str], hashes: list[str]) -> list[dict]:
+        # Module name components are stored one per key, as Chroma can only compare whole values
+        return [{"kind": kind, "hash": h, **{f"module_{i}": str(c) for i, c in enumerate(parse_record_id(doc_id)[0])}} for doc_id, kind, h in zip(ids, kinds, hashes)]
+
+    def add(self, ids: list[str], embeddings: Embeddings, kinds: list[str], hashes: list[str]):
+        self.collection.add(embeddings=embeddings, ids=ids, metadatas=self._metadatas(ids, kinds, hashes))
+
+    def delete(self, ids: list[str]):
+        for start in range(0, len(ids), 5000):
+            self.collection.delete(ids=ids[start : start + 5000])
+
+    def embeddings(self, ids: list[str]) -> np.ndarray:
+        ret = {}
+        for start in range(0, len(ids), 5000):
+            batch = self.collection.get(ids=ids[start : start + 5000], include=["embeddings"])
+            ret.update(zip(batch["ids"], batch["embeddings"]))
+        return np.asarray([ret[i] for i in ids], dtype=np.float32)
+
+    def query(self, embeddings: Embeddings, num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]:
+        results = self.collection.query(
+            query_embeddings=embeddings,
+            n_results=num_results,
+            where=_chroma_where(where) if where else None,
+            include=["distances"],
+        )
+        return [list(zip(ids, distances)) for ids, distances in zip(results["ids"], results["distances"])]
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def hashes(self) -> dict[str, str]:
+        ret = {}
+        while (batch := self.collection.get(include=["metadatas"], limit=10_000, offset=len(ret)))["ids"]:
+            ret.update((i, (m or {}).get("hash", "")) for i, m in zip(batch["ids"], batch["metadatas"]))
+        return ret
+
+    def set_metadata(self, ids: list[str], kinds: list[str], hashes: list[str]):
+        for start in range(0, len(ids), 5000):
+            end = start + 5000
+            self.collection.update(ids=ids[start:end], metadatas=self._metadatas(ids[start:end], kinds[start:end], hashes[start:end]))
+
+    def reopen(self) -> "ChromaBackend":
+        # Clients of the same path share a system, which keeps serving the HNSW index it loaded first; in-flight queries
+        # finish on the old system
+        SharedSystemClient.clear_system_cache()
+        return ChromaBackend(self.path)
+
+
+def _chroma_all(op: str, clauses: list[dict]) -> dict:
+    return clauses[0] if len(clauses) == 1 else {op: clauses}
+
+
+def _chroma_where(where: SearchFilter) -> dict:
+    clauses = []
+    if where.module_prefix and all(where.module_prefix):
+        prefixes = [_chroma_all("$and", [{f"module_{i}": str(c)} for i, c in enumerate(p)]) for p in where.module_prefix]
+        clauses.append(_chroma_all("$or", prefixes))
+    if where.kind:
+        clauses.append({"kind": {"$in": list(where.kind)}})
+    return _chroma_all("$and", clauses)
+
+
+class NumpyBackend(VectorBackend):
+    """Exact search over normalized float16 vectors in a memory-mapped matrix.
+
+    The whole query batch is scored against blocks of ``block_size`` rows with one matmul per block, and a running top-k
+    is kept with ``argpartition``. Deleted rows are only listed in ``deleted.txt`` and skipped, until :meth:`compact`
+    rewrites the index without them.
+    """
+
+    def __init__(self, path: str, create: bool = False, block_size: int = 4096):
+        self.path = Path(path)
+        self.vectors_path = self.path / "vectors.f16"
+        self.ids_path = self.path / "ids.txt"
+        self.kinds_path = self.path / "kinds.txt"
+        self.hashes_path = self.path / "hashes.txt"
+        self.deleted_path = self.path / "deleted.txt"
+        self.block_size = block_size
+        _restore(self.path)
+        if create and self.ids_path.exists():
+            self._repair()
+        elif create:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.vectors_path.touch()
+            self.kinds_path.touch()
+            self.hashes_path.touch()
+            self.ids_path.touch()
+        self._load()
+
+    def _load(self):
+        with open(self.ids_path) as fp:
+            self.ids = fp.read().splitlines()
+        self.row_hashes = _read_lines(self.hashes_path, len(self.ids))
+        self.deleted = {row for row in map(int, _read_lines(self.deleted_path)) if row < len(self.ids)}
+        # Live row of each id
+        self.rows = {i: row for row, i in enumerate(self.ids) if row not in self.deleted}
+        self._map()
+
+    def _repair(self) -> int:
+        # An interrupted add leaves rows past the last complete id, which the next add would be misaligned with
+        with open(self.ids_path) as fp:
+            ids = fp.read()
+        if not ids.endswith("\n"):
+            ids = ids[: ids.rfind("\n") + 1]
+            with open(self.ids_path, "w") as fp:
+                fp.write(ids)
+        count = ids.count("\n")
+        with open(self.vectors_path, "r+b") as fp:
+            fp.truncate(count * DIMENSION * 2)
+        for path in self.kinds_path, self.hashes_path:
+            lines = _read_lines(path, count)
+            with open(path, "w") as fp:
+                fp.writelines(line + "\n" for line in lines)
+        return count
+
+    def _map(self):
+        self.__dict__.pop("metadata", None)
+        self.__dict__.pop("live", None)
+        if self.ids:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(len(self.ids), DIMENSION))
+        else:
+            self.vectors = np.zeros((0, DIMENSION), dtype=np.float16)
+
+    @cached_property
+    def metadata(self) -> RowMetadata:
+        return RowMetadata((parse_record_id(i)[0] for i in self.ids), _read_lines(self.kinds_path, len(self.ids)))
+
+    @cached_property
+    def live(self) -> np.ndarray | None:
+        if not self.deleted:
+            return None
+        mask = np.ones(len(self.ids), dtype=np.bool_)
+        mask[list(self.deleted)] = False
+        return mask
+
+    def add(self, ids: list[str], embeddings: Embeddings, kinds: list[str], hashes: list[str]):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        # Vectors go first, so that an interrupted write never leaves an id without its vector
+        with open(self.vectors_path, "ab") as fp:
+            fp.write(vectors.astype(np.float16).tobytes())
+        with open(self.kinds_path, "a") as fp:
+            fp.writelines(k + "\n" for k in kinds)
+        with open(self.hashes_path, "a") as fp:
+            fp.writelines(h + "\n" for h in hashes)
+        with open(self.ids_path, "a") as fp:
+            fp.writelines(i + "\n" for i in ids)
+        self.rows.update((i, row) for row, i in enumerate(ids, len(self.ids)))
+        self.ids.extend(ids)
+        self.row_hashes.extend(hashes)
+        self._map()
+
+    def delete(self, ids: list[str]):
+        rows = [row for i in ids if (row := self.rows.pop(i, None)) is not None]
+        with open(self.deleted_path, "a") as fp:
+            fp.writelines(f"{row}\n" for row in rows)
+        self.deleted.update(rows)
+        self.__dict__.pop("live", None)
+
+    def embeddings(self, ids: list[str]) -> np.ndarray:
+        return np.asarray(self.vectors[[self.rows[i] for i in ids]], dtype=np.float32)
+
+    def reopen(self) -> "NumpyBackend":
+        return NumpyBackend(str(self.path), block_size=self.block_size)
+
+    def compact(self, threshold: float = 0.2):
+        """Rewrites the index without its deleted rows, once they are more than ``threshold`` of all rows.
+
+        The new index is written next to this one and swapped in by renaming directories, so that an interruption
+        leaves either of them in place.
+        """
+        if len(self.deleted) <= threshold * len(self.ids):
+            return
+        rows = np.array(sorted(self.rows.values()), dtype=np.int64)
+        new = self.path.with_name(self.path.name + ".compact")
+        old = self.path.with_name(self.path.name + ".old")
+        shutil.rmtree(new, ignore_errors=True)
+        new.mkdir()
+        self._write_rows(new, rows)
+        shutil.rmtree(old, ignore_errors=True)
+        self.path.rename(old)
+        new.rename(self.path)
+        shutil.rmtree(old)
+        self._load()
+
+    def _write_rows(self, path: Path, rows: np.ndarray):
+        _write_matrix_rows(self.vectors, rows, path / self.vectors_path.name)
+        for source, lines in (self.kinds_path, _read_lines(self.kinds_path, len(self.ids))), (self.hashes_path, self.row_hashes), (self.ids_path, self.ids):
+            (path / source.name).write_text("".join(lines[row] + "\n" for row in rows))
+
+    def query(self, embeddings: Embeddings, num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]:
+        queries = np.asarray(embeddings, dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        # Only the rows passing the filter are scanned, so a selective filter makes the search cheaper
+        mask = self.live
+        if where:
+            mask = self.metadata.mask(where) if mask is None else mask & self.metadata.mask(where)
+        rows, scores = self.top_k(queries, num_results, None if mask is None else np.flatnonzero(mask))
+        return [[(self.ids[r], 1 - float(s)) for r, s in zip(rs, ss)] for rs, ss in zip(rows, scores)]
+
+    def _blocks(self, matrix: np.ndarray, rows: np.ndarray | None) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        if rows is None:
+            for start in range(0, len(matrix), self.block_size):
+                yield np.arange(start, min(start + self.block_size, len(matrix))), matrix[start : start + self.block_size]
+        else:
+            for start in range(0, len(rows), self.block_size):
+                yield rows[start : start + self.block_size], matrix[rows[start : start + self.block_size]]
+
+    def top_k(self, queries: np.ndarray, k: int, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Rows and cosine similarities of the ``k`` nearest vectors to each normalized query, best first.
+
+        With ``rows``, only those rows are searched.
+        """
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for block_rows, block in self._blocks(self.vectors, rows):
+            best_rows, best_scores = _merge_top_k(
+                np.concatenate([best_rows, np.broadcast_to(block_rows, (len(queries), len(block_rows)))], axis=1),
+                np.concatenate([best_scores, queries @ np.asarray(block, dtype=np.float32).T], axis=1),
+                k,
+            )
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def count(self) -> int:
+        return len(self.rows)
+
+    def hashes(self) -> dict[str, str]:
+        return {i: self.row_hashes[row] for i, row in self.rows.items()}
+
+    def set_metadata(self, ids: list[str], kinds: list[str], hashes: list[str]):
+        row_kinds = _read_lines(self.kinds_path, len(self.ids))
+        for i, kind, h in zip(ids, kinds, hashes):
+            row = self.rows[i]
+            row_kinds[row] = kind
+            self.row_hashes[row] = h
+        # Replaced whole, so that an interrupted write leaves the previous file
+        for path, lines in (self.kinds_path, row_kinds), (self.hashes_path, self.row_hashes):
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text("".join(line + "\n" for line in lines))
+            tmp.replace(path)
+        self.__dict__.pop("metadata", None)
+
+
+class Int8Backend(NumpyBackend):
+    """A :class:`NumpyBackend` whose first pass scans int8 codes, a quarter the size of float32 vectors.
+
+    Each vector is scaled by its largest absolute component before rounding. The best ``k * rerank`` candidates of the
+    first pass are re-ranked with their float16 vectors, which therefore stay on disk and are only read for shortlists.
+    """
+
+    def __init__(self, path: str, create: bool = False, block_size: int = 4096, rerank: int = 4):
+        self.codes_path = Path(path) / "codes.i8"
+        self.scales_path = Path(path) / "scales.f32"
+        self.rerank = rerank
+        _restore(Path(path))
+        if create and not (Path(path) / "ids.txt").exists():
+            Path(path).mkdir(parents=True, exist_ok=True)
+            self.codes_path.touch()
+            self.scales_path.touch()
+        super().__init__(path, create=create, block_size=block_size)
+
+    def reopen(self) -> "Int8Backend":
+        return Int8Backend(str(self.path), block_size=self.block_size, rerank=self.rerank)
+
+    def _repair(self) -> int:
+        count = super()._repair()
+        with open(self.codes_path, "r+b") as fp:
+            fp.truncate(count * DIMENSION)
+        with open(self.scales_path, "r+b") as fp:
+            fp.truncate(count * 4)
+        return count
+
+    def _map(self):
+        super()._map()
+        if self.ids:
+            self.codes = np.memmap(self.codes_path, dtype=np.int8, mode="r", shape=(len(self.ids), DIMENSION))
+            self.scales = np.memmap(self.scales_path, dtype=np.float32, mode="r", shape=(len(self.ids),))
+        else:
+            self.codes = np.zeros((0, DIMENSION), dtype=np.int8)
+            self.scales = np.zeros(0, dtype=np.float32)
+
+    def _write_rows(self, path: Path, rows: np.ndarray):
+        _write_matrix_rows(self.codes, rows, path / self.codes_path.name)
+        _write_matrix_rows(self.scales, rows, path / self.scales_path.name)
+        super()._write_rows(path, rows)
+
+    def add(self, ids: list[str], embeddings: Embeddings, kinds: list[str], hashes: list[str]):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        scales = np.abs(vectors).max(axis=1) / 127
+        with open(self.codes_path, "ab") as fp:
+            fp.write(np.round(vectors / scales[:, None]).astype(np.int8).tobytes())
+        with open(self.scales_path, "ab") as fp:
+            fp.write(scales.astype(np.float32).tobytes())
+        super().add(ids, vectors, kinds, hashes)
+
+    def first_pass(self, queries: np.ndarray, k: int, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for block_rows, block in self._blocks(self.codes, rows):
+            best_rows, best_scores = _merge_top_k(
+                np.concatenate([best_rows, np.broadcast_to(block_rows, (len(queries), len(block_rows)))], axis=1),
+                np.concatenate([best_scores, (queries @ np.asarray(block, dtype=np.float32).T) * self.scales[block_rows]], axis=1),
+                k,
+            )
+        return best_rows, best_scores
+
+    def top_k(self, queries: np.ndarray, k: int, rows: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        candidates, _ = self.first_pass(queries, k * self.rerank, rows)
+        # Candidates shared by several queries are read from disk once
+        unique, inverse = np.unique(candidates, return_inverse=True)
+        scores = queries @ np.asarray(self.vectors[unique], dtype=np.float32).T
+        scores = np.take_along_axis(scores, inverse.reshape(candidates.shape), axis=1)
+        best_rows, best_scores = _merge_top_k(candidates, scores, k)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def evaluate(self, num_queries: int, k: int) -> dict[str, float]:
+        """Recall@k against exact float16 search, using a sample of the indexed vectors as queries, and index sizes."""
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(len(self.ids), size=min(num_queries, len(self.ids)), replace=False))
+        queries = np.asarray(self.vectors[sample], dtype=np.float32)
+        exact, _ = NumpyBackend.top_k(self, queries, k)
+
+        def recall(rows: np.ndarray) -> float:
+            return float(np.mean([len(set(e) & set(r[:k])) / len(e) for e, r in zip(exact, rows)]))
+
+        return {
+            "recall_first_pass": recall(self.first_pass(queries, k)[0]),
+            "recall_reranked": recall(self.top_k(queries, k)[0]),
+            "bytes_float32": len(self.ids) * DIMENSION * 4,
+            "bytes_float16": self.vectors.nbytes,
+            "bytes_int8": self.codes.nbytes + self.scales.nbytes,
+        }
+
+
+def _read_lines(path: Path, count: int | None = None) -> list[str]:
+    # Files of indexes built before they were introduced are missing, and read as empty lines
+    lines = path.read_text().splitlines() if path.exists() else []
+    return lines if count is None else lines[:count] + [""] * (count - len(lines))
+
+
+def _restore(path: Path):
+    # A compaction interrupted between its two renames leaves only the previous index
+    old = path.with_name(path.name + ".old")
+    if not path.exists() and old.exists():
+        old.rename(path)
+
+
+def _write_matrix_rows(matrix: np.ndarray, rows: np.ndarray, path: Path, chunk_size: int = 65536):
+    with open(path, "wb") as fp:
+        for start in range(0, len(rows), chunk_size):
+            fp.write(np.ascontiguousarray(matrix[rows[start : start + chunk_size]]).tobytes())
+
+
+def _merge_top_k(rows: np.ndarray, scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    if scores.shape[1] <= k:
+        return rows, scores
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(rows, part, axis=1), np.take_along_axis(scores, part, axis=1)
+
+
+BACKENDS: dict[str, type[VectorBackend]] = {
+    "chroma": ChromaBackend,
+    "numpy": NumpyBackend,
+    "int8": Int8Backend,
+}
+
+
+def open_vector_backend(path: str, create: bool = False) -> VectorBackend:
+    return BACKENDS[os.environ.get("VECTOR_BACKEND", "chroma")](path, create=create)
@@ -1,48 +1,190 @@
+import asyncio
+import hashlib
 import os
 import logging
+import time
+from collections import Counter
 
-import chromadb
-from jixia.structs import pp_name
+import numpy as np
 from psycopg import Connection
 
 from .embedding import MistralEmbedding
+from .vector_backend import open_vector_backend, record_id
 
 logger = logging.getLogger(__name__)
 
-def create_vector_db(conn: Connection, path: str, batch_size: int):
+Batch = list[tuple[str, str, str, str]]
+
+DOCUMENT_QUERY = """
+    SELECT s.name, d.module_name, d.index, s.kind, d.kind, d.signature, s.type, i.name, i.description
+    FROM
+        symbol s
+        LEFT JOIN declaration d ON s.id = d.symbol_id
+        INNER JOIN informal i ON s.id = i.symbol_id
+    WHERE d.visible = TRUE
+"""
+
+
+def _document(row: tuple) -> tuple[str, str, str, str]:
+    """Id, embedded text, declaration kind and text hash of a row of ``DOCUMENT_QUERY``."""
+    name, module_name, index, kind, declaration_kind, signature, tp, informal_name, informal_description = row
+    if signature is None:
+        signature = tp
+    doc = f"{kind} {name} {signature}\n{informal_name}: {informal_description}"
+    return record_id(module_name, index), doc, declaration_kind, hashlib.sha256(doc.encode()).hexdigest()
+
+
+def create_vector_db(conn: Connection, path: str, batch_size: int, concurrency: int = 4):
+    """Embeds every visible declaration with an informal description into the vector index at ``path``.
+
+    Up to ``concurrency`` embedding requests of ``batch_size`` documents are in flight while further rows are read and
+    embedded batches are written. Every written batch is durable, and declarations already in the index with the same
+    document are skipped, so an interrupted build continues where it stopped when run again, and a build on an updated
+    database only embeds the changed declarations. A declaration whose id changed, as its index in the module shifted,
+    but whose document is already embedded under another id gets a copy of that embedding. Embeddings of declarations
+    no longer in the database are deleted.
+    """
+    asyncio.run(_create_vector_db(conn, path, batch_size, concurrency))
+
+
+def _document_hashes(conn: Connection) -> dict[str, str]:
+    with conn.cursor("document_hashes") as cursor:
+        cursor.execute(DOCUMENT_QUERY)
+        return {doc_id: doc_hash for doc_id, _, _, doc_hash in map(_document, cursor)}
+
+
+async def _create_vector_db(conn: Connection, path: str, batch_size: int, concurrency: int):
     with open("prompt/embedding_instruction.txt") as fp:
         instruction = fp.read()
     embedding = MistralEmbedding(os.environ["EMBEDDING_URL"], instruction)
 
-    client = chromadb.PersistentClient(path)
-    collection = client.create_collection(
-        name="leansearch",
-        metadata={"hnsw:space": "cosine"},
-        embedding_function=None,
-    )
+    backend = await asyncio.to_thread(open_vector_backend, path, True)
+    done = await asyncio.to_thread(backend.hashes)
+    if done:
+        logger.info("updating %d embeddings already in %s", len(done), path)
+
+    inflight = asyncio.Semaphore(concurrency)
+    embedded: asyncio.Queue[tuple[Batch, list | None] | None] = asyncio.Queue(maxsize=concurrency)
+    start = time.monotonic()
+    written = Counter()
+    dry_run = os.environ["DRY_RUN"] == "true"
+
+    # Ids whose embedding is still that of each document hash, the number of changed ids wanting a copy of it, and the
+    # copies of those whose last such id was overwritten before all of them were made
+    sources: dict[str, set[str]] = {}
+    for doc_id, doc_hash in done.items():
+        if doc_hash:
+            sources.setdefault(doc_hash, set()).add(doc_id)
+    wanted = Counter()
+    stash: dict[str, np.ndarray] = {}
+
+    def store(batch: Batch, batch_embedding: list | None):
+        ids = [i for i, _, _, _ in batch]
+        hashes = [h for _, _, _, h in batch]
+        if batch_embedding is None:
+            missing = [h for h in dict.fromkeys(hashes) if h not in stash]
+            fetched = dict(zip(missing, backend.embeddings([next(iter(sources[h])) for h in missing])))
+            batch_embedding = []
+            for h in hashes:
+                batch_embedding.append(stash[h] if h in stash else fetched[h])
+                wanted[h] -= 1
+                if not wanted[h]:
+                    stash.pop(h, None)
+        if stale := [i for i in ids if i in done]:
+            keep = {}
+            for i in stale:
+                if h := done[i]:
+                    sources[h].discard(i)
+                    if wanted[h] and not sources[h] and h not in stash:
+                        keep[h] = i
+            if keep:
+                stash.update(zip(keep, backend.embeddings(list(keep.values()))))
+            backend.delete(stale)
+        backend.add(ids, batch_embedding, [k for _, _, k, _ in batch], hashes)
+
+    async def embed(batch: Batch):
+        # The slot is freed once the batch is in the bounded queue of the writer, so that embedded batches waiting for a
+        # slow writer stay bounded
+        try:
+            batch_embedding = await embedding.aembed([doc for _, doc, _, _ in batch])
+            await embedded.put((batch, batch_embedding))
+        finally:
+            inflight.release()
+
+    async def write():
+        # A single writer, as the backends are not safe for concurrent adds
+        while (item := await embedded.get()) is not None:
+            batch, batch_embedding = item
+            await asyncio.to_thread(store, batch, batch_embedding)
+            written["embedded" if batch_embedding is not None else "copied"] += len(batch)
+            logger.info("embedded %d and copied %d declarations (%.1f/s)", written["embedded"], written["copied"], written.total() / (time.monotonic() - start))
+
+    try:
+        with conn.transaction():
+            # Both passes over the documents read the same snapshot
+            await asyncio.to_thread(conn.execute, "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            current = await asyncio.to_thread(_document_hashes, conn)
+            changed = {doc_id: doc_hash for doc_id, doc_hash in current.items() if done.get(doc_id) != doc_hash}
+            wanted.update(doc_hash for doc_hash in changed.values() if doc_hash in sources)
+            with conn.cursor("vector_db") as cursor:
+                await asyncio.to_thread(cursor.execute, DOCUMENT_QUERY)
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(write())
+                    async with asyncio.TaskGroup() as embedders:
+                        batch: Batch = []
+                        copies: Batch = []
+                        while not (dry_run and batch) and (rows := await asyncio.to_thread(cursor.fetchmany, 1000)):
+                            for row in rows:
+                                doc_id, doc, declaration_kind, doc_hash = _document(row)
+                                if doc_id not in changed:
+                                    continue
+                                if doc_hash in wanted:
+                                    if not dry_run:
+                                        copies.append((doc_id, doc, declaration_kind, doc_hash))
+                                    if len(copies) == 1000:
+                                        await embedded.put((copies, None))
+                                        copies = []
+                                    continue
+                                batch.append((doc_id, doc, declaration_kind, doc_hash))
+                                if dry_run:
+                                    logger.info("DRY_RUN:skipped embedding: %s", doc.partition("\n")[0])
+                                if len(batch) == batch_size:
+                                    if dry_run:
+                                        break
+                                    await inflight.acquire()
+                                    embedders.create_task(embed(batch))
+                                    batch = []
+                        if batch and not dry_run:
+                            await inflight.acquire()
+                            embedders.create_task(embed(batch))
+                    if copies:
+                        await embedded.put((copies, None))
+                    await embedded.put(None)
+    finally:
+        await embedding.aclose()
+    if removed := [] if dry_run else [i for i in done if i not in current]:
+        await asyncio.to_thread(backend.delete, removed)
+    if not dry_run:
+        await asyncio.to_thread(backend.compact)
+    logger.info("embedded %d, copied %d and deleted %d embeddings; %d in total", written["embedded"], written["copied"], len(removed), backend.count())
+
+
+def backfill_document_hashes(conn: Connection, path: str):
+    """Records the kind and document hash of embeddings in the index at ``path`` that were added without them.
 
+    Meant to run on upgrade, before the project is parsed again, when the database still holds what they were embedded
+    from, so that the next build only embeds the declarations changed since.
+    """
+    backend = open_vector_backend(path)
+    missing = {doc_id for doc_id, doc_hash in backend.hashes().items() if not doc_hash}
+    ids, kinds, hashes = [], [], []
     with conn.cursor() as cursor:
-        cursor.execute("""
-            SELECT s.name, d.module_name, d.index, s.kind, d.signature, s.type, i.name, i.description
-            FROM
-                symbol s
-                LEFT JOIN declaration d ON s.name = d.name
-                INNER JOIN informal i ON s.name = i.symbol_name
-            WHERE d.visible = TRUE
-        """)
-
-        while batch := cursor.fetchmany(batch_size):
-            batch_doc = []
-            batch_id = []
-            for name, module_name, index, kind, signature, tp, informal_name, informal_description in batch:
-                if signature is None:
-                    signature = tp
-                batch_doc.append(f"{kind} {name} {signature}\n{informal_name}: {informal_description}")
-                # NOTE: the space character is not used in names from mathlib and its dependencies
-                batch_id.append(" ".join(str(x) for x in name))
-                if os.environ["DRY_RUN"] == "true":
-                    logger.info("DRY_RUN:skipped embedding: %s", f"{kind} {name} {signature} {informal_name}")
-            if os.environ["DRY_RUN"] == "true":
-                return
-            batch_embedding = embedding.embed(batch_doc)
-            collection.add(embeddings=batch_embedding, ids=batch_id)
+        cursor.execute(DOCUMENT_QUERY)
+        for row in cursor:
+            doc_id, _, declaration_kind, doc_hash = _document(row)
+            if doc_id in missing:
+                ids.append(doc_id)
+                kinds.append(declaration_kind)
+                hashes.append(doc_hash)
+    backend.set_metadata(ids, kinds, hashes)
+    logger.info("recorded the document hash of %d embeddings in %s", len(ids), path)
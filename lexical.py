@@ -0,0 +1,122 @@
+import bisect
+import math
+import re
+from collections import defaultdict
+from collections.abc import Iterable
+
+import numpy as np
+from jixia.structs import LeanName, pp_name
+
+from database.vector_backend import Hit, RowMetadata, SearchFilter, record_id
+
+_WORD = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+|[^\W\d_A-Za-z]+")
+# Dotted, snake_case or camelCase words, which natural language queries rarely contain
+_IDENTIFIER = re.compile(r"[\w'!?]*(\.[\w'!?]|_|[a-z][A-Z])[\w.'!?]*")
+
+# Scores of the identifier matches, above anything BM25 gives in practice
+EXACT_SCORE = 1000.0
+SUFFIX_SCORE = 100.0
+PREFIX_SCORE = 10.0
+NAME_WEIGHT = 3
+EXACT_DISTANCE = 1 / (1 + EXACT_SCORE)
+
+
+def tokenize(text: str) -> list[str]:
+    return [w.lower() for w in _WORD.findall(text)]
+
+
+def is_identifier(word: str) -> bool:
+    return _IDENTIFIER.fullmatch(word) is not None
+
+
+class LexicalIndex:
+    """BM25 over declaration names, signatures and informal names, plus exact, suffix and prefix lookup of names."""
+
+    def __init__(self, rows: Iterable[tuple[LeanName, int, LeanName, str, str, str]], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: list[str] = []
+        self.full_names: list[str] = []
+        self.names: dict[str, list[int]] = defaultdict(list)
+        postings: dict[str, dict[int, int]] = defaultdict(dict)
+        lengths = []
+        modules = []
+        kinds = []
+        for doc, (module_name, index, name, kind, signature, informal_name) in enumerate(rows):
+            self.ids.append(record_id(module_name, index))
+            self.full_names.append(pp_name(name))
+            modules.append(module_name)
+            kinds.append(kind)
+            # Every dotted suffix, so that `sum_comm` and `Finset.sum_comm` both find `Finset.sum_comm`
+            for i in range(len(name)):
+                self.names[pp_name(name[i:])].append(doc)
+            tokens = tokenize(self.full_names[-1]) * NAME_WEIGHT + tokenize(signature) + tokenize(informal_name)
+            lengths.append(len(tokens))
+            for t in tokens:
+                postings[t][doc] = postings[t].get(doc, 0) + 1
+
+        self.metadata = RowMetadata(modules, kinds)
+        self.lengths = np.array(lengths, dtype=np.float32)
+        self.average_length = float(self.lengths.mean()) if lengths else 0.0
+        self.postings = {t: (np.fromiter(p.keys(), dtype=np.int32), np.fromiter(p.values(), dtype=np.float32)) for t, p in postings.items()}
+        self.sorted_names = sorted(self.names)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def classify(self, query: str) -> str:
+        """``"identifier"`` for a lone identifier, ``"mixed"`` for text containing identifiers, otherwise ``"text"``."""
+        words = query.split()
+        identifiers = sum(is_identifier(w) for w in words)
+        if identifiers == 0:
+            return "text"
+        return "identifier" if len(words) == 1 else "mixed"
+
+    def bm25(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for t in set(tokenize(query)):
+            if t not in self.postings:
+                continue
+            docs, tf = self.postings[t]
+            idf = math.log(1 + (len(self.ids) - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[docs] / self.average_length)
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, num_results: int, where: SearchFilter | None = None) -> list[Hit]:
+        scores = self.bm25(query)
+        for word in query.split():
+            if not is_identifier(word):
+                continue
+            for doc in self.names.get(word, []):
+                scores[doc] += EXACT_SCORE if self.full_names[doc] == word else SUFFIX_SCORE
+            # Incomplete identifiers such as `continuous_of_`, shorter names first
+            start = bisect.bisect_left(self.sorted_names, word)
+            for n in self.sorted_names[start : start + 10 * num_results]:
+                if not n.startswith(word):
+                    break
+                for doc in self.names[n]:
+                    scores[doc] += PREFIX_SCORE / len(n)
+        if where:
+            scores[~self.metadata.mask(where)] = 0
+        top = np.flatnonzero(scores)
+        top = top[np.argsort(-scores[top], kind="stable")[:num_results]]
+        return [(self.ids[doc], 1 / (1 + float(scores[doc]))) for doc in top]
+
+
+def fuse(rankings: list[list[Hit]], num_results: int, k: int = 60) -> list[Hit]:
+    """Reciprocal rank fusion; the distance is ``1 - score / best possible score``."""
+    scores: dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, (doc_id, _) in enumerate(ranking):
+            scores[doc_id] += 1 / (k + rank + 1)
+    best = len(rankings) / (k + 1)
+    ranked = sorted(scores.items(), key=lambda x: -x[1])[:num_results]
+    return [(doc_id, 1 - score / best) for doc_id, score in ranked]
+
+
+def hybrid(vector_hits: list[Hit], lexical_hits: list[Hit], num_results: int) -> list[Hit]:
+    """Fuses both rankings, except that exact name matches of the lexical index stay on top."""
+    exact = [(doc_id, 0.0) for doc_id, distance in lexical_hits if distance <= EXACT_DISTANCE]
+    pinned = {doc_id for doc_id, _ in exact}
+    return (exact + [h for h in fuse([vector_hits, lexical_hits], num_results) if h[0] not in pinned])[:num_results]
@@ -0,0 +1,91 @@
+import time
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram:
+    """A Prometheus histogram, optionally with one label."""
+
+    def __init__(self, name: str, help: str, label: str | None = None, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # Per label value: the count of each bucket (not cumulative, the last one being +Inf), and the sum
+        self.series: dict[str | None, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, label: str | None = None):
+        counts, total = self.series.setdefault(label, ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))] += 1
+        total[0] += value
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, (counts, total) in sorted(self.series.items(), key=lambda x: x[0] or ""):
+            labels = "" if label is None else f'{self.label}="{label}",'
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{labels} {total[0]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("leansearch_stage_seconds", "Time spent in each stage of serving a request.", "stage")
+REQUEST_SECONDS = Histogram("leansearch_request_seconds", "Time spent serving a request, by endpoint.", "path")
+EMBEDDING_BATCH_SIZE = Histogram("leansearch_embedding_batch_size", "Number of queries embedded in one call.", buckets=SIZE_BUCKETS)
+HISTOGRAMS = [STAGE_SECONDS, REQUEST_SECONDS, EMBEDDING_BATCH_SIZE]
+
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Records the time spent in the block for ``stage``, in the histogram and in the timings of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        # Stages run in another task, such as a coalesced search, only count towards the histogram
+        if (timings := _timings.get()) is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def request_timings() -> Iterator[dict[str, float]]:
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def server_timing(timings: Mapping[str, float]) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def stat_lines(prefix: str, stats: Mapping[str, int | float], counters: set[str]) -> list[str]:
+    """Exposes the numbers in a ``stats()`` dict as gauges, or as counters for the keys in ``counters``."""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, Mapping):
+            continue
+        name = f"{prefix}_{key}_total" if key in counters else f"{prefix}_{key}"
+        lines += [f"# TYPE {name} {'counter' if key in counters else 'gauge'}", f"{name} {value}"]
+    return lines
+
+
+def expose(*stat_groups: list[str]) -> str:
+    lines = [line for histogram in HISTOGRAMS for line in histogram.expose()]
+    for group in stat_groups:
+        lines += group
+    return "\n".join(lines) + "\n"
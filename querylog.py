@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from jixia.structs import LeanName
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Longest wait before retrying a failed write
+MAX_RETRY_INTERVAL = 30.0
+
+
+class QueryLog:
+    """Buffers search queries and feedback in memory and writes them to ``leansearch`` in batches, off the request path.
+
+    A batch is written every ``interval`` seconds, or as soon as ``batch_size`` rows are pending. At most ``max_pending``
+    rows are buffered; beyond that, while the database is slow or down, new rows are dropped and counted. A batch that
+    fails to be written is put back and retried with exponential backoff.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, interval: float, batch_size: int, max_pending: int):
+        self.pool = pool
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.queries: list[tuple[uuid.UUID, str, datetime]] = []
+        # Feedback by (query id, declaration), and the feedback cancelled since the last batch, deleted before it is inserted
+        self.feedback: dict[tuple[uuid.UUID, tuple[str, ...]], str] = {}
+        self.cancelled: set[tuple[uuid.UUID, tuple[str, ...]]] = set()
+        self.counters = Counter()
+        self.wake = asyncio.Event()
+        self.closing = False
+        self.failures = 0
+        self.task: asyncio.Task | None = None
+
+    @property
+    def pending(self) -> int:
+        return len(self.queries) + len(self.feedback) + len(self.cancelled)
+
+    def log_query(self, query: str) -> uuid.UUID:
+        """Buffers ``query`` and returns its id, which is also the session id of the feedback on its results."""
+        query_id = uuid.uuid4()
+        if self._admit("queries"):
+            self.queries.append((query_id, query, datetime.now(timezone.utc)))
+        return query_id
+
+    def log_feedback(self, query_id: uuid.UUID, declaration: LeanName, action: str):
+        if self._admit("feedback"):
+            self.feedback.setdefault((query_id, tuple(declaration)), action)
+
+    def cancel_feedback(self, query_id: uuid.UUID, declaration: LeanName):
+        key = (query_id, tuple(declaration))
+        self.feedback.pop(key, None)
+        if self._admit("feedback"):
+            self.cancelled.add(key)
+
+    def _admit(self, kind: str) -> bool:
+        if self.pending >= self.max_pending:
+            self.counters[f"{kind}_dropped"] += 1
+            return False
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        if self.pending + 1 >= self.batch_size and not self.failures:
+            self.wake.set()
+        return True
+
+    async def close(self):
+        if self.task is not None:
+            self.closing = True
+            self.wake.set()
+            await self.task
+            self.task = None
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, **self.counters}
+
+    async def _run(self):
+        while not self.closing:
+            # After a failed write, the next one waits for a backoff instead of a full batch
+            delay = min(self.interval * 2**self.failures, MAX_RETRY_INTERVAL)
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except TimeoutError:
+                pass
+            self.wake.clear()
+            self.failures = 0 if await self._write() else self.failures + 1
+        # Rows buffered while the last batch was written
+        if not await self._write():
+            self.counters["queries_failed"] += len(self.queries)
+            self.counters["feedback_failed"] += len(self.feedback) + len(self.cancelled)
+            self.queries, self.feedback, self.cancelled = [], {}, set()
+
+    async def _write(self) -> bool:
+        """Writes the pending rows, or puts them back to be retried and returns ``False`` if that failed."""
+        queries, self.queries = self.queries, []
+        feedback, self.feedback = self.feedback, {}
+        cancelled, self.cancelled = self.cancelled, set()
+        if not queries and not feedback and not cancelled:
+            return True
+        rejected = 0
+        try:
+            async with self.pool.connection() as conn, conn.transaction(), conn.cursor() as cursor:
+                if queries:
+                    # Stored in the server's time zone, as NOW() was
+                    await cursor.execute(
+                        """
+                        INSERT INTO leansearch.query(id, query, time)
+                        SELECT id, query, time AT TIME ZONE current_setting('TimeZone')
+                        FROM UNNEST(%s::UUID[], %s::TEXT[], %s::TIMESTAMPTZ[]) AS q(id, query, time)
+                        """,
+                        ([query_id for query_id, _, _ in queries], [query for _, query, _ in queries], [time for _, _, time in queries]),
+                    )
+                if cancelled:
+                    await cursor.execute(
+                        """
+                        DELETE FROM leansearch.feedback f
+                        USING UNNEST(%s::UUID[], %s::JSONB[]) AS c(query_id, declaration_name)
+                        WHERE f.query_id = c.query_id AND f.declaration_name = c.declaration_name
+                        """,
+                        ([query_id for query_id, _ in cancelled], [Jsonb(list(name)) for _, name in cancelled]),
+                    )
+                if feedback:
+                    # Feedback on a query that was never logged cannot reference it, and existing feedback is kept
+                    await cursor.execute(
+                        """
+                        INSERT INTO leansearch.feedback(query_id, declaration_name, action)
+                        SELECT s.query_id, s.declaration_name, s.action
+                        FROM UNNEST(%s::UUID[], %s::JSONB[], %s::TEXT[]) AS s(query_id, declaration_name, action)
+                        WHERE EXISTS (SELECT 1 FROM leansearch.query q WHERE q.id = s.query_id)
+                        ON CONFLICT DO NOTHING
+                        """,
+                        ([query_id for query_id, _ in feedback], [Jsonb(list(name)) for _, name in feedback], list(feedback.values())),
+                    )
+                    rejected = len(feedback) - cursor.rowcount
+        except Exception:
+            logger.exception("failed to write %d queries and %d feedback; retrying", len(queries), len(feedback) + len(cancelled))
+            self._requeue(queries, feedback, cancelled)
+            return False
+        self.counters["batches"] += 1
+        self.counters["queries_written"] += len(queries)
+        self.counters["feedback_written"] += len(feedback) - rejected + len(cancelled)
+        self.counters["feedback_rejected"] += rejected
+        return True
+
+    def _requeue(self, queries: list, feedback: dict, cancelled: set):
+        """Puts a failed batch back in front of the rows buffered since, as far as ``max_pending`` allows.
+
+        Queries come first, as feedback can only be written after its query. Within each kind, the oldest rows that
+        do not fit are dropped and counted as failed, and feedback cancelled since is not put back.
+        """
+        room = max(self.max_pending - self.pending, 0)
+        kept_queries = queries[len(queries) - min(room, len(queries)) :]
+        room -= len(kept_queries)
+        cancelled = list(cancelled - self.cancelled)
+        kept_cancelled = cancelled[:room]
+        room -= len(kept_cancelled)
+        feedback = [(key, action) for key, action in feedback.items() if key not in self.cancelled]
+        kept_feedback = dict(feedback[len(feedback) - min(room, len(feedback)) :])
+        self.counters["queries_failed"] += len(queries) - len(kept_queries)
+        self.counters["feedback_failed"] += len(cancelled) - len(kept_cancelled) + len(feedback) - len(kept_feedback)
+        self.queries = kept_queries + self.queries
+        # The earlier action on a declaration is kept, as it is when both are written
+        kept_feedback.update((key, action) for key, action in self.feedback.items() if key not in kept_feedback)
+        self.feedback = kept_feedback
+        self.cancelled.update(kept_cancelled)
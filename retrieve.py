@@ -1,22 +1,32 @@
+import asyncio
+import logging
 import os
-from collections.abc import Iterable
+from collections.abc import AsyncIterator, Iterable, Sequence
+from typing import Any, Literal
 
-import chromadb
-from jixia.structs import LeanName, DeclarationKind, parse_name
-from psycopg import Connection
-from psycopg.rows import class_row
+from jixia.structs import LeanName, DeclarationKind
+from psycopg import AsyncConnection, sql
+from psycopg.rows import dict_row
 from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
 from pydantic import BaseModel, ConfigDict
 
-from database.embedding import MistralEmbedding
+from batcher import SearchBatcher
+from database.embedding import EmbeddingCache, EmbeddingStore, MistralEmbedding
+from database.record_store import RecordStore
+from database.vector_backend import Hit, SearchFilter, open_vector_backend, parse_record_id
+from lexical import LexicalIndex, hybrid
+from metrics import EMBEDDING_BATCH_SIZE, timed
+
+logger = logging.getLogger(__name__)
 
 
 class Record(BaseModel):
     module_name: LeanName
     kind: DeclarationKind
     name: LeanName
-    start: int
-    stop: int
+    start: int | None
+    stop: int | None
     signature: str
     type: str
     value: str | None
@@ -27,56 +37,252 @@ class Record(BaseModel):
     model_config = ConfigDict(extra="allow")
 
 
+RecordField = Literal["module_name", "index", "kind", "name", "start", "stop", "signature", "type", "value", "docstring", "informal_name", "informal_description"]
+
+
+def _columns(fields: Sequence[RecordField] | None, *keys: str) -> sql.Composable:
+    if fields is None:
+        return sql.SQL("r.*")
+    return sql.SQL(", ").join(sql.Identifier("r", c) for c in dict.fromkeys([*keys, *fields]))
+
+
+def _record(row: dict[str, Any], fields: Sequence[RecordField] | None) -> Record:
+    if fields is None:
+        return Record(**row)
+    # Fields that were not selected stay unset, and are left out when serializing with ``exclude_unset``
+    return Record.model_construct(**{f: row[f] for f in fields})
+
+
 class QueryResult(BaseModel):
     result: Record
     distance: float
 
 
+class FetchResult(BaseModel):
+    results: list[Record]
+    missing: list[LeanName]
+
+
+def _file_key(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
 class Retriever:
-    def __init__(self, path: str, conn: Connection):
-        self.conn = conn
-        self.client = chromadb.PersistentClient(path)
-        self.collection = self.client.get_collection(name="leansearch", embedding_function=None)
+    def __init__(self, path: str):
+        self.vectors = open_vector_backend(path)
+        self.vectors_version: int | None = None
         with open("prompt/retrieve_instruction.txt") as fp:
             instruction = fp.read()
-        self.embedding = MistralEmbedding(os.environ["EMBEDDING_URL"], instruction)
+        store = None
+        if store_path := os.environ.get("EMBEDDING_CACHE_PATH"):
+            store = EmbeddingStore(store_path, int(os.environ.get("EMBEDDING_CACHE_STORE_SIZE", 100_000)))
+        self.embedding_cache = EmbeddingCache(int(os.environ.get("EMBEDDING_CACHE_SIZE", 10_000)), store)
+        self.embedding = MistralEmbedding(os.environ["EMBEDDING_URL"], instruction, self.embedding_cache)
+        self.batcher = None
+        if window := int(os.environ.get("SEARCH_BATCH_WINDOW_MS", 0)):
+            self.batcher = SearchBatcher(self._nearest, window / 1000, int(os.environ.get("SEARCH_BATCH_SIZE", 64)))
+        # Hydration is served from an exported record store, if there is one, instead of Postgres
+        self.records = None
+        self.records_path = os.environ.get("RECORD_STORE_PATH") or None
+        self.records_file: tuple[int, int] | None = None
+        if self.records_path is not None:
+            self.records = RecordStore(self.records_path)
+            self.records_file = _file_key(self.records_path)
+        self.lexical: LexicalIndex | None = None
+        self.lexical_pool: AsyncConnectionPool | None = None
+        self.lexical_version = -1
 
-    def batch_fetch(self, name: Iterable[LeanName]) -> list[Record]:
-        ret = []
-        with self.conn.cursor(row_factory=class_row(Record)) as cursor:
-            for n in name:
-                cursor.execute(
-                    """
-                    SELECT * FROM record
-                    WHERE name = %s
-                    """,
-                    (Jsonb(n),),
+    async def load_lexical(self, pool: AsyncConnectionPool):
+        """Builds the lexical index over the declarations in the vector index, and rebuilds it from ``pool`` on every
+        :meth:`refresh` to a new version."""
+        self.lexical_pool = pool
+        async with pool.connection() as conn, conn.transaction(), conn.cursor() as cursor:
+            await cursor.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM index_version")
+            (version,) = await cursor.fetchone()
+            await cursor.execute(
+                """
+                SELECT r.module_name, r.index, r.name, r.kind, r.signature, r.informal_name
+                FROM record r INNER JOIN declaration d ON r.module_name = d.module_name AND r.index = d.index
+                WHERE d.visible = TRUE
+                """
+            )
+            rows = await cursor.fetchall()
+        # The index being served meanwhile is swapped only once the new one is built
+        self.lexical = await asyncio.to_thread(LexicalIndex, rows)
+        self.lexical_version = version
+        logger.info("built lexical index over %d records at index version %d", len(self.lexical), version)
+
+    async def refresh(self, version: int) -> bool:
+        """Follows ``index_version``, once it is ``version``; ``False`` if something could not be brought up to date."""
+        ok = await self._refresh_vectors(version)
+        if self.records_path is not None:
+            self._refresh_records(version)
+        if self.lexical_pool is not None and self.lexical_version != version:
+            try:
+                await self.load_lexical(self.lexical_pool)
+            except Exception:
+                logger.exception("failed to rebuild the lexical index; serving the previous one")
+                ok = False
+        return ok
+
+    async def _refresh_vectors(self, version: int) -> bool:
+        # Record ids are positions in modules, so hits from an index older than the database name other declarations
+        if self.vectors_version is None:
+            self.vectors_version = version
+        if self.vectors_version == version:
+            return True
+        previous, self.vectors_version = self.vectors_version, version
+        try:
+            self.vectors = await asyncio.to_thread(self.vectors.reopen)
+        except Exception:
+            logger.exception("failed to reopen the vector index; serving the previous one")
+            self.vectors_version = previous
+            return False
+        logger.info("reopened vector index with %d embeddings at index version %d", self.vectors.count(), version)
+        return True
+
+    def _refresh_records(self, version: int):
+        if self.records is not None and self.records.version == version:
+            return
+        if self.records is not None:
+            logger.warning("record store is from index version %d, not %d; hydrating from PostgreSQL until it is exported again", self.records.version, version)
+            self.records.close()
+            self.records = None
+        # The export replaces the file, so an unchanged file is still stale
+        try:
+            key = _file_key(self.records_path)
+        except FileNotFoundError:
+            return
+        if key == self.records_file:
+            return
+        self.records_file = key
+        store = RecordStore(self.records_path)
+        if store.version == version:
+            logger.info("reopened record store at index version %d", version)
+            self.records = store
+        else:
+            store.close()
+
+    async def close(self):
+        if self.batcher is not None:
+            await self.batcher.close()
+        await self.embedding.aclose()
+        self.embedding_cache.close()
+        if self.records is not None:
+            self.records.close()
+
+    async def batch_fetch(self, conn: AsyncConnection, name: Iterable[LeanName], fields: Sequence[RecordField] | None = None) -> FetchResult:
+        name = list(name)
+        unique = set(map(tuple, name))
+        if self.records is not None:
+            rows = ((n, self.records.find_name(n)) for n in unique)
+            columns = None if fields is None else dict.fromkeys(["name", *fields])
+            records = {n: _record(self.records.row(row, columns), fields) for n, row in rows if row is not None}
+        else:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute(
+                    sql.SQL("""
+                    SELECT {} FROM record r
+                    WHERE name = ANY(%s::jsonb[])
+                    """).format(_columns(fields, "name")),
+                    ([Jsonb(n) for n in unique],),
                 )
-                ret.append(cursor.fetchone())
+                records = {tuple(r["name"]): _record(r, fields) async for r in cursor}
+        ret = FetchResult(results=[], missing=[])
+        for n in name:
+            record = records.get(tuple(n))
+            if record is None:
+                ret.missing.append(n)
+            else:
+                ret.results.append(record)
         return ret
 
-    def batch_search(self, query: list[str], num_results: int) -> list[list[QueryResult]]:
-        query_embedding = self.embedding.embed(query)
-        results = self.collection.query(
-            query_embeddings=query_embedding,
-            n_results=num_results,
-            include=["distances"],
-        )
-        ret = []
-        with self.conn.cursor(row_factory=class_row(Record)) as cursor:
-            for ids, distances in zip(results["ids"], results["distances"]):
-                current_results = []
-                for doc_id, distance in zip(ids, distances):
-                    module_name, _, index = doc_id.partition(":")
-                    module_name = parse_name(module_name)
-                    cursor.execute(
-                        """
-                        SELECT * FROM record
-                        WHERE module_name = %s AND index = %s
-                        """,
-                        (Jsonb(module_name), index),
+    async def hydrate(self, conn: AsyncConnection, keys: Iterable[tuple[LeanName, int]], fields: Sequence[RecordField] | None = None) -> dict[tuple[tuple, int], Record]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        with timed("hydrate"):
+            if self.records is not None:
+                rows = (self.records.find(m, i) for m, i in keys)
+                columns = None if fields is None else dict.fromkeys(["module_name", "index", *fields])
+                rows = [self.records.row(row, columns) for row in rows if row is not None]
+            else:
+                async with conn.cursor(row_factory=dict_row) as cursor:
+                    await cursor.execute(
+                        sql.SQL("""
+                        SELECT {} FROM record r
+                        JOIN UNNEST(%s::jsonb[], %s::integer[]) AS k(module_name, index) USING (module_name, index)
+                        """).format(_columns(fields, "module_name", "index")),
+                        ([Jsonb(m) for m, _ in keys], [i for _, i in keys]),
                     )
-                    result = cursor.fetchone()
-                    current_results.append(QueryResult(result=result, distance=distance))
-                ret.append(current_results)
+                    rows = await cursor.fetchall()
+        return {(tuple(r["module_name"]), r["index"]): _record(r, fields) for r in rows}
+
+    async def nearest(self, query: list[str], num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]:
+        if self.batcher is not None:
+            # Embedding and vector search then happen in the batcher's task, and only this wait is in Server-Timing
+            with timed("batched_search"):
+                return await self.batcher.submit(query, num_results, where)
+        return await self._nearest(query, num_results, where)
+
+    async def _nearest(self, query: list[str], num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]:
+        EMBEDDING_BATCH_SIZE.observe(len(query))
+        with timed("embed"):
+            query_embedding = await self.embedding.aembed(query)
+        with timed("vector"):
+            return await asyncio.to_thread(self.vectors.query, query_embedding, num_results, where)
+
+    async def search(self, query: list[str], num_results: int, where: SearchFilter | None = None) -> list[list[Hit]]:
+        if self.lexical is None:
+            return await self.nearest(query, num_results, where)
+        # A lone identifier is answered by the lexical index alone, without an embedding, unless it matches no name
+        kinds = [self.lexical.classify(q) for q in query]
+        lexical_query = [q for q, k in zip(query, kinds) if k != "text"]
+        with timed("lexical"):
+            lexical_hits = iter(await asyncio.to_thread(lambda: [self.lexical.search(q, num_results, where) for q in lexical_query]))
+        lexical = [next(lexical_hits) if k != "text" else [] for k in kinds]
+        vector_query = [q for q, k, hits in zip(query, kinds, lexical) if k != "identifier" or not hits]
+        vector_hits = iter(await self.nearest(vector_query, num_results, where) if vector_query else [])
+        ret = []
+        for k, hits in zip(kinds, lexical):
+            if k == "identifier" and hits:
+                ret.append(hits)
+            elif k == "mixed":
+                ret.append(hybrid(next(vector_hits), hits, num_results))
+            else:
+                ret.append(next(vector_hits))
+        return ret
+
+    async def batch_search(self, conn: AsyncConnection, query: list[str], num_results: int, where: SearchFilter | None = None, fields: Sequence[RecordField] | None = None) -> list[list[QueryResult]]:
+        hits = await self.search(query, num_results, where)
+        return await self._results(conn, hits, {}, fields)
+
+    async def iter_search(self, conn: AsyncConnection, query: list[str], num_results: int, where: SearchFilter | None = None, fields: Sequence[RecordField] | None = None) -> AsyncIterator[tuple[int, list[QueryResult]]]:
+        """Like :meth:`batch_search`, but yields ``(i, results)`` as soon as the ``i``-th query is hydrated."""
+        hits = await self.search(query, num_results, where)
+        records = {}
+        for i, query_hits in enumerate(hits):
+            yield i, (await self._results(conn, [query_hits], records, fields))[0]
+
+    async def _results(self, conn: AsyncConnection, hits: list[list[Hit]], records: dict[tuple[tuple, int], Record], fields: Sequence[RecordField] | None) -> list[list[QueryResult]]:
+        # Queries often share hits, so each distinct id is looked up only once; ``records`` holds those already looked up
+        keys = {}
+        for query_hits in hits:
+            for doc_id, _ in query_hits:
+                if doc_id not in keys:
+                    keys[doc_id] = parse_record_id(doc_id)
+        records.update(await self.hydrate(conn, (k for k in keys.values() if (tuple(k[0]), k[1]) not in records), fields))
+
+        ret = []
+        for query_hits in hits:
+            current_results = []
+            for doc_id, distance in query_hits:
+                module_name, index = keys[doc_id]
+                result = records.get((tuple(module_name), index))
+                if result is None:
+                    logger.warning("no record found for search hit %s; skipping", doc_id)
+                    continue
+                current_results.append(QueryResult(result=result, distance=distance))
+            ret.append(current_results)
         return ret
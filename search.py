@@ -1,3 +1,4 @@
+import asyncio
 import os
 from argparse import ArgumentParser
 
@@ -9,10 +10,11 @@ from pydantic import TypeAdapter
 from retrieve import Retriever, QueryResult
 
 
-def main(query: list[str], num_results: int, json_output: bool):
-    with psycopg.connect(os.environ["CONNECTION_STRING"], autocommit=True) as conn:
-        retriever = Retriever(os.environ["CHROMA_PATH"], conn)
-        results = retriever.batch_search(query, num_results)
+async def main(query: list[str], num_results: int, json_output: bool):
+    async with await psycopg.AsyncConnection.connect(os.environ["CONNECTION_STRING"], autocommit=True) as conn:
+        retriever = Retriever(os.environ["CHROMA_PATH"])
+        results = await retriever.batch_search(conn, query, num_results)
+        await retriever.close()
         if json_output:
             print(TypeAdapter(list[list[QueryResult]]).dump_json(results).decode())
         else:
@@ -36,4 +38,4 @@ if __name__ == "__main__":
     parser.add_argument("--json", action="store_true", help="Output in JSON format")
     parser.add_argument("query", nargs="+", help="Any number of query strings")
     args = parser.parse_args()
-    main(args.query, args.num, args.json)
+    asyncio.run(main(args.query, args.num, args.json))
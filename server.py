@@ -1,17 +1,21 @@
+import base64
+import json
 import os
+import time
 import uuid
+from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
+from functools import partial
 from typing import Annotated
 
 import dotenv
-import psycopg
-from fastapi import FastAPI, Body, Response, Cookie
-from jixia.structs import LeanName
-from psycopg import Connection
-from psycopg.rows import scalar_row
-from psycopg.types.json import Jsonb
-from psycopg_pool import ConnectionPool
-from pydantic import BaseModel
+import msgpack
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, Response, Cookie
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from jixia.structs import DeclarationKind, LeanName, parse_name
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
@@ -19,68 +23,194 @@ from slowapi.util import get_remote_address
 from starlette.requests import Request
 
 from augment import Augmentor
-from retrieve import QueryResult, Retriever, Record
+from cache import ResultCache
+from database.vector_backend import SearchFilter
+from metrics import REQUEST_SECONDS, expose, request_timings, server_timing, stat_lines, timed
+from querylog import QueryLog
+from retrieve import FetchResult, QueryResult, RecordField, Retriever
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     dotenv.load_dotenv()
-    with ConnectionPool(
+    async with AsyncConnectionPool(
             os.environ["CONNECTION_STRING"],
             kwargs={"autocommit": True},
-            check=ConnectionPool.check_connection,
+            check=AsyncConnectionPool.check_connection,
+            open=False,
     ) as pool:
         app.augmentor = Augmentor(os.environ["OPENAI_MODEL"])
-        app.retriever = Retriever(os.environ["CHROMA_PATH"], None)
+        app.retriever = Retriever(os.environ["CHROMA_PATH"])
+        app.result_cache = ResultCache(
+            int(os.environ.get("RESULT_CACHE_SIZE", 10_000)),
+            float(os.environ.get("INDEX_VERSION_INTERVAL", 5)),
+            app.retriever.refresh,
+        )
         app.pool = pool
+        app.query_log = QueryLog(
+            pool,
+            float(os.environ.get("QUERY_LOG_INTERVAL_MS", 250)) / 1000,
+            int(os.environ.get("QUERY_LOG_BATCH_SIZE", 500)),
+            int(os.environ.get("QUERY_LOG_MAX_PENDING", 100_000)),
+        )
+        if os.environ.get("LEXICAL_INDEX", "false") == "true":
+            await app.retriever.load_lexical(pool)
         yield
+        await app.query_log.close()
+        await app.retriever.close()
 
 
 limiter = Limiter(key_func=get_remote_address, default_limits=["1/second"])
 app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.add_middleware(SlowAPIMiddleware)
 
 
 @app.middleware("http")
-async def set_connection(request: Request, call_next):
-    with app.pool.connection() as conn:
-        app.retriever.conn = conn
-        return await call_next(request)
+async def timing(request: Request, call_next):
+    start = time.perf_counter()
+    with request_timings() as timings:
+        response = await call_next(request)
+    # For a streamed response, this is the time until its headers
+    elapsed = time.perf_counter() - start
+    path = request.url.path if any(route.path == request.url.path for route in app.routes) else "other"
+    REQUEST_SECONDS.observe(elapsed, path)
+    response.headers["Server-Timing"] = server_timing({**timings, "total": elapsed})
+    return response
 
 
-app.add_middleware(SlowAPIMiddleware)
+async def get_connection() -> AsyncIterator[AsyncConnection]:
+    async with app.pool.connection() as conn:
+        yield conn
+
+
+Connection = Annotated[AsyncConnection, Depends(get_connection)]
+
+
+MAX_RESULTS = 150
+MSGPACK = "application/msgpack"
+SEARCH_RESULTS = TypeAdapter(list[list[QueryResult]])
+SEARCH_PAGE = TypeAdapter(list[QueryResult])
+FETCH_RESULT = TypeAdapter(FetchResult)
+
+
+def render(request: Request, response: Response, adapter: TypeAdapter, content) -> Response:
+    """Serializes ``content`` as msgpack if the client accepts it and as JSON otherwise, leaving out fields not selected."""
+    with timed("serialize"):
+        if MSGPACK in request.headers.get("accept", ""):
+            return Response(msgpack.packb(adapter.dump_python(content, mode="json", exclude_unset=True)), media_type=MSGPACK, headers=response.headers)
+        return Response(adapter.dump_json(content, exclude_unset=True), media_type="application/json", headers=response.headers)
+
+
+def selected(fields: list[RecordField] | None) -> tuple[RecordField, ...] | None:
+    return None if fields is None else tuple(dict.fromkeys(fields))
+
+
+class SearchCursor(BaseModel):
+    query: str
+    module_prefix: list[str]
+    kind: list[DeclarationKind]
+    fields: list[RecordField] | None
+    num_results: int
+    offset: int
+    version: int
+
+    @property
+    def where(self) -> SearchFilter:
+        return search_filter(self.module_prefix, self.kind)
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self.model_dump_json().encode()).decode()
+
+    @classmethod
+    def decode(cls, token: str) -> "SearchCursor":
+        try:
+            return cls.model_validate_json(base64.urlsafe_b64decode(token))
+        except (ValueError, ValidationError):
+            raise HTTPException(400, "invalid cursor")
+
+
+def search_filter(module_prefix: list[str], kind: list[DeclarationKind]) -> SearchFilter:
+    return SearchFilter(tuple(sorted({tuple(parse_name(p)) for p in module_prefix})), tuple(sorted(set(kind))))
+
+
+def next_cursor(cursor: SearchCursor, results: list[QueryResult]) -> str | None:
+    # Results stop short of a page only when the index has no more
+    if len(results) < cursor.num_results or cursor.offset + 2 * cursor.num_results > MAX_RESULTS:
+        return None
+    return cursor.model_copy(update={"offset": cursor.offset + cursor.num_results}).encode()
+
+
+def prefetched(num_results: int) -> int:
+    # Later pages can be computed and cached along with the first one, so that following the cursor is a cache hit; by
+    # default they are not, as every search would then pay for pages most clients never ask for
+    return min(MAX_RESULTS, num_results * int(os.environ.get("SEARCH_PREFETCH_PAGES", 1)))
 
 
 @app.post("/search")
-def search(
+async def search(
+        request: Request,
+        conn: Connection,
         response: Response,
         query: list[str],
-        num_results: Annotated[int, Body(gt=0, le=150)] = 10,
+        num_results: Annotated[int, Body(gt=0, le=MAX_RESULTS)] = 10,
+        module_prefix: Annotated[list[str], Body()] = [],
+        kind: Annotated[list[DeclarationKind], Body()] = [],
+        fields: Annotated[list[RecordField] | None, Body()] = None,
+        stream: Annotated[bool, Body()] = False,
 ) -> list[list[QueryResult]]:
+    session_ids = [app.query_log.log_query(q) for q in query]
     if len(query) == 1:
-        with app.retriever.conn.cursor(row_factory=scalar_row) as cursor:
-            cursor.execute("""
-                           INSERT INTO leansearch.query(id, query, time)
-                           VALUES (GEN_RANDOM_UUID(), %s, NOW())
-                           RETURNING id
-                           """, (query[0],))
-            session_id = cursor.fetchone()
-            response.set_cookie("session", str(session_id))
-    else:
-        with app.retriever.conn.cursor() as cursor:
-            cursor.executemany("""
-                               INSERT INTO leansearch.query(id, query, time)
-                               VALUES (GEN_RANDOM_UUID(), %s, NOW())
-                               """, [(q,) for q in query])
+        response.set_cookie("session", str(session_ids[0]))
+
+    where = search_filter(module_prefix, kind)
+
+    def cursor_of(q: str) -> SearchCursor:
+        return SearchCursor(query=q, module_prefix=module_prefix, kind=kind, fields=fields, num_results=num_results, offset=0, version=app.result_cache.version)
+
+    if stream:
+        # The connection of the dependency is released before streaming starts
+        async def lines() -> AsyncIterator[str]:
+            async with app.pool.connection() as conn:
+                async for i, results in app.result_cache.iter_search(conn, query, prefetched(num_results), partial(app.retriever.iter_search, conn), where, selected(fields)):
+                    results = results[:num_results]
+                    line = {"index": i, "results": SEARCH_PAGE.dump_python(results, mode="json", exclude_unset=True), "cursor": next_cursor(cursor_of(query[i]), results)}
+                    yield json.dumps(line) + "\n"
 
-    return app.retriever.batch_search(query, num_results)
+        return StreamingResponse(lines(), media_type="application/x-ndjson", headers=response.headers)
+
+    ret = await app.result_cache.batch_search(conn, query, prefetched(num_results), partial(app.retriever.batch_search, conn), where, selected(fields))
+    ret = [results[:num_results] for results in ret]
+    if len(query) == 1 and (token := next_cursor(cursor_of(query[0]), ret[0])) is not None:
+        response.headers["Search-Cursor"] = token
+    return render(request, response, SEARCH_RESULTS, ret)
+
+
+@app.post("/search/next")
+async def search_next(request: Request, conn: Connection, response: Response, cursor: Annotated[str, Body(embed=True)]) -> list[QueryResult]:
+    cursor = SearchCursor.decode(cursor)
+    end = cursor.offset + cursor.num_results
+    [results] = await app.result_cache.batch_search(conn, [cursor.query], end, partial(app.retriever.batch_search, conn), cursor.where, selected(cursor.fields))
+    if app.result_cache.version != cursor.version:
+        raise HTTPException(410, "the index changed since the first page; search again")
+    results = results[cursor.offset : end]
+    if (token := next_cursor(cursor, results)) is not None:
+        response.headers["Search-Cursor"] = token
+    return render(request, response, SEARCH_PAGE, results)
 
 
 @app.post("/fetch")
 @limiter.limit("10/second")
-def fetch(request: Request, query: list[LeanName]) -> list[Record]:
-    return app.retriever.batch_fetch(query)
+async def fetch(
+        request: Request,
+        conn: Connection,
+        response: Response,
+        query: Annotated[list[LeanName], Body(max_length=1000)],
+        fields: Annotated[list[RecordField] | None, Query()] = None,
+) -> FetchResult:
+    await app.result_cache.check_version(conn)
+    return render(request, response, FETCH_RESULT, await app.retriever.batch_fetch(conn, query, selected(fields)))
 
 
 @app.post("/augment")
@@ -90,6 +220,24 @@ async def augment(request: Request, query: Annotated[str, Body()]) -> str:
     return augmented
 
 
+POOL_MEASURES = {"pool_min", "pool_max", "pool_size", "pool_available", "requests_waiting"}
+
+
+@app.get("/metrics")
+@limiter.exempt
+async def metrics() -> PlainTextResponse:
+    pool_stats = app.pool.get_stats()
+    groups = [
+        stat_lines("leansearch_pool", pool_stats, set(pool_stats) - POOL_MEASURES),
+        stat_lines("leansearch_result_cache", app.result_cache.stats(), {"hits", "misses", "coalesced"}),
+        stat_lines("leansearch_embedding_cache", app.retriever.embedding_cache.stats(), {"hits", "store_hits", "misses"}),
+        stat_lines("leansearch_query_log", app.query_log.stats(), set(app.query_log.counters)),
+    ]
+    if app.retriever.batcher is not None:
+        groups.append(stat_lines("leansearch_search_batcher", app.retriever.batcher.stats(), set()))
+    return PlainTextResponse(expose(*groups), media_type="text/plain; version=0.0.4")
+
+
 class Feedback(BaseModel):
     declaration: LeanName
     action: str
@@ -100,14 +248,6 @@ class Feedback(BaseModel):
 async def feedback(session: Annotated[str, Cookie()], body: Feedback):
     query_id = uuid.UUID(session)
     if body.cancel:
-        with app.retriever.conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM leansearch.feedback WHERE query_id = %s AND declaration_name = %s",
-                (query_id, Jsonb(body.declaration))
-            )
+        app.query_log.cancel_feedback(query_id, body.declaration)
     else:
-        with app.retriever.conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO leansearch.feedback(query_id, declaration_name, action) VALUES (%s, %s, %s)",
-                (query_id, Jsonb(body.declaration), body.action)
-            )
+        app.query_log.log_feedback(query_id, body.declaration, body.action)